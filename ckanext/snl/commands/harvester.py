@@ -43,7 +43,7 @@ class Harvester(CkanCommand):
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
-      harvester [-j] [--segments={segments}] import [{source-id}]
+      harvester [-j] [--segments={segments}] [--batch-size={size}] import [{source-id}]
         - perform the import stage with the last fetched objects, optionally belonging to a certain source.
           Please note that no objects will be fetched from the remote server. It will only affect
           the last fetched objects already present in the database.
@@ -54,6 +54,10 @@ class Harvester(CkanCommand):
           The --segments flag allows to define a string containing hex digits that represent which of
           the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f
 
+          The --batch-size flag imports the SNL objects in batches of the given size: the imported
+          datasets are sent to the search index in bulk at the end of each batch instead of one
+          by one. An object that fails does not affect the rest of its batch.
+
       harvester job-all
         - create new harvest jobs for all active sources.
 
@@ -85,6 +89,9 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+            default=0, help='Index the imported datasets in batches of this size')
+
     def command(self):
         self._load_config()
 
@@ -278,7 +285,14 @@ class Harvester(CkanCommand):
                    'segments': self.options.segments}
 
 
-        objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
+        if self.options.batch_size:
+            from ckanext.snl.harvesters import SNLHarvester
+            SNLHarvester.start_batch_import(self.options.batch_size)
+        try:
+            objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
+        finally:
+            if self.options.batch_size:
+                SNLHarvester.finish_batch_import()
 
         print '%s objects reimported' % len(objs)
 
@@ -2,6 +2,7 @@ import ckan.lib.cli
 import sys
 
 from ckanext.snl.helpers import oai
+from ckanext.snl.helpers import benchmark
 
 
 class SNLCommand(ckan.lib.cli.CkanCommand):
@@ -16,11 +17,16 @@ class SNLCommand(ckan.lib.cli.CkanCommand):
         paster snl help
 
         # Export the oai entries for the specified set
+        # (continues from the checkpoint of a failed export of the set)
         paster snl export <set name>
 
         # Resume export of the oai entries for the specified set
+        # at a given record count
         paster snl resume <set name> <start record count> <limit record count>
 
+        # Time the metadata parser on a synthetic metadata file
+        paster snl benchmark [<number of datasets>]
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -37,7 +43,8 @@ class SNLCommand(ckan.lib.cli.CkanCommand):
             'help': self.helpCmd,
             'export': self.exportCmd,
             'resume': self.resumeCmd,
-            'dump': self.dumpCmd
+            'dump': self.dumpCmd,
+            'benchmark': self.benchmarkCmd
         }
 
         try:
@@ -77,3 +84,12 @@ class SNLCommand(ckan.lib.cli.CkanCommand):
     def dumpCmd(self, set_name):
         oai_helper = oai.OAI('ch.nb')
         oai_helper.dump(set_name)
+
+    def benchmarkCmd(self, dataset_count=5000):
+        dataset_count = int(dataset_count)
+        seconds = benchmark.benchmark_metadata_parser(dataset_count)
+        print 'Parsed %d datasets in %.2fs (%.0f datasets/s)' % (
+            dataset_count,
+            seconds,
+            dataset_count / seconds
+        )
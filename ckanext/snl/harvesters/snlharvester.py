@@ -1,26 +1,87 @@
 # -*- coding: utf-8 -*-
 
 import os
-import tempfile
-import urllib3
-import shutil
+import datetime
+import hashlib
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from pylons import config
 
 from ckan import model
 from ckan.model import Session
-from ckan.logic import get_action, action
+from ckan.logic import get_action, action, NotFound
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_title_to_name
+from ckan.lib import search
+from ckan import plugins
 
 from ckanext.harvest.model import HarvestObject
 from ckanext.harvest.harvesters import HarvesterBase
 
 from ckanext.snl.helpers import oai
+from ckanext.snl.helpers import storage
+from ckanext.snl.helpers import workdir
+from ckanext.snl.helpers.transport import HTTPTransport
 from ckanext.snl.helpers.xml_metadata import MetaDataParser
 
 import logging
 log = logging.getLogger(__name__)
 
 
+class IdCache(object):
+    '''
+    Ids that stay the same for a whole harvest job (group, organization
+    and harvest user), kept for ttl seconds so that import_stage does not
+    look them up for every dataset.
+
+    invalidate() drops them, e.g. after an import failed because one of
+    them no longer exists.
+    '''
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._ids = {}
+
+    def get(self, name, lookup):
+        '''
+        Return the cached id or store and return the result of lookup()
+        '''
+        loaded_at, value = self._ids.get(name, (None, None))
+        if loaded_at is not None and time.time() - loaded_at <= self.ttl:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = lookup()
+        self._ids[name] = (time.time(), value)
+        return value
+
+    def invalidate(self):
+        self._ids.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def log_stats(self):
+        log.debug(
+            'Id cache: %d hits, %d misses (hit rate %.0f%%)'
+            % (self.hits, self.misses, 100 * self.hit_rate())
+        )
+
+
+# ids shared by all harvest objects imported by the process
+_id_cache = IdCache()
+
+# {job id: {(term, lang_code): term_translation}} of the translations
+# submitted during the current job
+_submitted_translations = {}
+
+
 class SNLHarvester(HarvesterBase):
     '''
     The harvester for snl
@@ -28,6 +89,11 @@ class SNLHarvester(HarvesterBase):
 
     HARVEST_USER = u'harvest'
 
+    # batch import state of the process, see start_batch_import
+    _batch_size = 0
+    _batch_package_ids = []
+    _batch_indexing_deferred = False
+
     METADATA_FILE_URL = 'http://ead.nb.admin.ch/ogd/OGD_Metadaten_NB.xml'
     METADATA_FILE_NAME = 'OGD_Metadaten_NB.xml'
 
@@ -80,18 +146,155 @@ class SNLHarvester(HarvesterBase):
 
     def _fetch_metadata_file(self):
         '''
-        Fetching the Excel metadata file from the NB and save on disk
+        Fetching the metadata file from the NB and save on disk.
+
+        The last version is kept in the work directory, it is only
+        downloaded again if it changed (conditional GET).
         '''
-        http = urllib3.PoolManager()
+        local_path = os.path.join(
+            workdir.get_work_dir('metadata'),
+            self.METADATA_FILE_NAME
+        )
+        state_path = local_path + '.json'
+        headers = {}
+        if os.path.exists(local_path) and os.path.exists(state_path):
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
 
         log.debug('Fetch metadata file from %s' % self.METADATA_FILE_URL)
-        temp_dir = tempfile.mkdtemp()
-        local_path = os.path.join(temp_dir, self.METADATA_FILE_NAME)
-        metadata_file = http.request('GET', self.METADATA_FILE_URL)
-        with open(local_path, 'w') as local_file:
-            local_file.write(metadata_file.data)
+        metadata_file = HTTPTransport().request(
+            'GET',
+            self.METADATA_FILE_URL,
+            headers=headers,
+            preload_content=False
+        )
+        try:
+            if metadata_file.status == 304:
+                log.info('Metadata file not modified, using %s' % local_path)
+                return local_path
+            if metadata_file.status != 200:
+                raise Exception(
+                    'Fetching metadata file failed with HTTP status %s'
+                    % metadata_file.status
+                )
+
+            # stream the file to disk instead of buffering it
+            with open(local_path + '.tmp', 'w') as local_file:
+                for chunk in iter(lambda: metadata_file.read(65536), ''):
+                    local_file.write(chunk)
+            os.rename(local_path + '.tmp', local_path)
+        finally:
+            metadata_file.release_conn()
+        with open(state_path, 'w') as state_file:
+            json.dump({
+                'etag': metadata_file.headers.get('etag'),
+                'last_modified': metadata_file.headers.get('last-modified'),
+            }, state_file)
         return local_path
 
+    def _content_hash(self, metadata):
+        '''
+        Hash of the definition of a dataset in the metadata file
+        '''
+        return hashlib.sha1(json.dumps(metadata, sort_keys=True)).hexdigest()
+
+    def _is_due(self, metadata):
+        '''
+        Check if a dataset has to be harvested: its definition changed,
+        its export is older than ckanext.snl.export_max_age hours or its
+        data is appended (new records are checked on every run)
+        '''
+        if metadata.get('append_data') == u'True':
+            return True
+
+        previous = Session.query(HarvestObject).filter(
+            HarvestObject.guid == metadata['id'],
+            HarvestObject.current == True  # noqa
+        ).first()
+        if previous is None or previous.import_finished is None:
+            return True
+        try:
+            previous_hash = json.loads(previous.content).get('content_hash')
+        except (TypeError, ValueError):
+            return True
+        if previous_hash != metadata['content_hash']:
+            return True
+
+        max_age = datetime.timedelta(
+            hours=int(config.get('ckanext.snl.export_max_age', 168))
+        )
+        return previous.import_finished < datetime.datetime.now() - max_age
+
+    @classmethod
+    def start_batch_import(cls, batch_size):
+        '''
+        Import in batches: instead of indexing every package when it is
+        saved, the ids of the imported packages are collected and sent to
+        the search index in bulk every batch_size packages
+        '''
+        cls._batch_size = batch_size
+        cls._batch_package_ids = []
+        try:
+            plugins.unload('synchronous_search')
+            cls._batch_indexing_deferred = True
+        except Exception, e:
+            log.warning(
+                'Could not defer search indexing, packages are indexed '
+                'on save: %s' % e
+            )
+            cls._batch_indexing_deferred = False
+
+    @classmethod
+    def finish_batch_import(cls):
+        '''
+        Index the last batch and restore indexing on save
+        '''
+        try:
+            cls._index_batch()
+        finally:
+            if cls._batch_indexing_deferred:
+                plugins.load('synchronous_search')
+            cls._batch_size = 0
+            cls._batch_indexing_deferred = False
+
+    @classmethod
+    def _index_batch(cls):
+        package_ids = cls._batch_package_ids
+        cls._batch_package_ids = []
+        if not package_ids or not cls._batch_indexing_deferred:
+            return
+        start = time.time()
+        indexed = 0
+        context = {
+            'model': model,
+            'ignore_auth': True,
+            'validate': False,
+            'use_cache': False
+        }
+        # rebuild(package_id) would commit to Solr for every package
+        package_index = search.index_for(model.Package)
+        for package_id in package_ids:
+            try:
+                pkg_dict = get_action('package_show')(
+                    dict(context),
+                    {'id': package_id}
+                )
+                package_index.update_dict(pkg_dict, defer_commit=True)
+                indexed += 1
+            except Exception, e:
+                # the package is saved, it is indexed by the next rebuild
+                log.exception(e)
+                log.error('Indexing package %s failed' % package_id)
+        search.commit()
+        log.info(
+            'Indexed %d of %d packages in %.1fs'
+            % (indexed, len(package_ids), time.time() - start)
+        )
+
     def info(self):
         return {
             'name': 'snl',
@@ -105,76 +308,138 @@ class SNLHarvester(HarvesterBase):
 
         metadata_path = self._fetch_metadata_file()
         ids = []
-        try:
-            parser = MetaDataParser(metadata_path)
+        parser = MetaDataParser(metadata_path)
 
-            for dataset in parser.list_datasets():
-                metadata = parser.parse_set(dataset)
-                metadata['translations'].extend(
-                    self._metadata_term_translations()
-                )
+        for dataset in parser.list_datasets():
+            metadata = parser.parse_set(dataset)
+            metadata['content_hash'] = self._content_hash(metadata)
+            if not self._is_due(metadata):
+                log.info('Dataset %s is unchanged, skipping' % metadata['id'])
+                continue
 
-                log.debug(metadata)
+            log.debug(metadata)
 
-                obj = HarvestObject(
-                    guid=metadata['id'],
-                    job=harvest_job,
-                    content=json.dumps(metadata)
-                )
-                obj.save()
-                log.debug('adding ' + metadata['id'] + ' to the queue')
-                ids.append(obj.id)
-        finally:
-            temp_dir = os.path.dirname(metadata_path)
-            log.debug('Deleting directory ' + temp_dir)
-            shutil.rmtree(temp_dir)
+            obj = HarvestObject(
+                guid=metadata['id'],
+                job=harvest_job,
+                content=json.dumps(metadata)
+            )
+            obj.save()
+            log.debug('adding ' + metadata['id'] + ' to the queue')
+            ids.append(obj.id)
 
         return ids
 
+    def _export_resource(self, package_dict, resource, export_storage,
+                         transport, compress):
+        '''
+        Export an OAI resource and add its URLs and sizes, return the error
+        message if the export failed
+        '''
+        metadata_prefix = resource['metadata_prefix']
+        oai_helper = oai.OAI(
+            package_dict['bucket_prefix'],
+            resource['oai_url'],
+            metadata_prefix,
+            export_storage=export_storage,
+            transport=transport
+        )
+        try:
+            record_file_url = oai_helper.export(
+                package_dict['id'],
+                append=package_dict['append_data'] == u'True',
+                export_filename=resource['export_filename'],
+                metadata_prefix=metadata_prefix,
+                compress=compress,
+                record_filter=package_dict.get('record_filter')
+            )
+            log.debug('Record file URL: %s' % record_file_url)
+            if record_file_url is None:
+                # e.g. a set without records, nothing to publish
+                raise Exception(
+                    '%s of set %s does not exist'
+                    % (resource['export_filename'], package_dict['id'])
+                )
+            resource['url'] = record_file_url
+            resource['size'] = oai_helper.get_size_of_file(
+                package_dict['id'],
+                resource['export_filename']
+            )
+            log.debug('Size added to resource.')
+            if compress:
+                (resource['compressed_url'],
+                 resource['compressed_size']) = \
+                    oai_helper.get_compressed_file(
+                        package_dict['id'],
+                        resource['export_filename']
+                    )
+                log.debug('Compressed file added to resource.')
+        except Exception, e:
+            log.exception(e)
+            return (
+                'Error while exporting oai file %s: %s'
+                % (resource['export_filename'], e)
+            )
+        return None
+
     def fetch_stage(self, harvest_object):
         log.debug('In SNLHarvester fetch_stage')
         package_dict = json.loads(harvest_object.content)
-        bucket_prefix = package_dict['bucket_prefix']
-        append = True if package_dict['append_data'] == u'True' else False
+        try:
+            compress = oai.compression_enabled()
+        except oai.UnknownCompressionError, e:
+            log.error(e)
+            self._save_object_error(str(e), harvest_object)
+            return False
+        concurrency = int(config.get('ckanext.snl.export_concurrency', 2))
+
+        # one storage connection and HTTP pool for all resources
+        export_storage = storage.get_storage()
+        transport = HTTPTransport(maxsize=max(4, 2 * concurrency))
 
+        oai_resources = []
         for resource in package_dict['resources']:
-            oai_url = resource['oai_url']
-            metadata_prefix = resource['metadata_prefix']
-            oai_helper = oai.OAI(bucket_prefix, oai_url, metadata_prefix)
             if resource['type'] == 'oai':
-                try:
-                    record_file_url = oai_helper.export(
-                        package_dict['id'],
-                        append=append,
-                        export_filename=resource['export_filename'],
-                        metadata_prefix=metadata_prefix
-                    )
-                    log.debug('Record file URL: %s' % record_file_url)
-                    resource['url'] = record_file_url
-                    resource['size'] = oai_helper.get_size_of_file(
-                        package_dict['id'],
-                        resource['export_filename']
-                    )
-                    log.debug('Size added to resource.')
-                except Exception, e:
-                    log.exception(e)
-                    self._save_object_error(
-                        'Error while exporting oai file: %s' % e,
-                        harvest_object
-                    )
-                    return False
+                oai_resources.append(resource)
+                continue
+            size = export_storage.get_size_of_file(
+                package_dict['bucket_prefix'] + '.statisch',
+                resource['export_filename']
+            )
+            if size is not None:
+                resource['size'] = size
+                log.debug('Size added to resource.')
             else:
-                try:
-                    resource['size'] = oai_helper.get_size_of_file(
-                        'statisch',
-                        resource['export_filename']
-                    )
-                    log.debug('Size added to resource.')
-                except AttributeError:
-                    log.debug(
-                        'Can\'t get file size: %s is not hosted on S3.' %
-                        resource['export_filename']
-                    )
+                log.debug(
+                    'Can\'t get file size: %s is not hosted on S3.' %
+                    resource['export_filename']
+                )
+
+        def export(resource):
+            return self._export_resource(
+                package_dict,
+                resource,
+                export_storage,
+                transport,
+                compress
+            )
+
+        if len(oai_resources) > 1 and concurrency > 1:
+            pool = ThreadPool(min(concurrency, len(oai_resources)))
+            try:
+                errors = pool.map(export, oai_resources)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = [export(resource) for resource in oai_resources]
+
+        # the session must only be used by this thread
+        errors = [error for error in errors if error is not None]
+        for error in errors:
+            self._save_object_error(error, harvest_object)
+        if errors:
+            return False
 
         harvest_object.content = json.dumps(package_dict)
         harvest_object.save()
@@ -192,7 +457,10 @@ class SNLHarvester(HarvesterBase):
         try:
             package_dict = json.loads(harvest_object.content)
 
-            user = model.User.get(self.HARVEST_USER)
+            _id_cache.ttl = int(
+                config.get('ckanext.snl.id_cache_ttl', 600)
+            )
+            user_id = _id_cache.get('user', self._get_harvest_user_id)
 
             context = {
                 'model': model,
@@ -201,12 +469,16 @@ class SNLHarvester(HarvesterBase):
             }
 
             # Find or create group the dataset should get assigned to
-            package_dict['groups'] = self._find_or_create_groups(context)
+            package_dict['groups'] = _id_cache.get(
+                'groups',
+                lambda: self._find_or_create_groups(context)
+            )
 
             # Find or create the organization
             # the dataset should get assigned to
-            package_dict['owner_org'] = self._find_or_create_organization(
-                context
+            package_dict['owner_org'] = _id_cache.get(
+                'organization',
+                lambda: self._find_or_create_organization(context)
             )
 
             # Never import state from data source!
@@ -224,7 +496,7 @@ class SNLHarvester(HarvesterBase):
             package = model.Package.get(package_dict['id'])
             model.PackageRole(
                 package=package,
-                user=user,
+                user_id=user_id,
                 role=model.Role.ADMIN
             )
 
@@ -232,20 +504,40 @@ class SNLHarvester(HarvesterBase):
             self._create_or_update_package(package_dict, harvest_object)
 
             log.debug('Save or update term translations')
-            self._submit_term_translations(context, package_dict)
+            self._submit_term_translations(
+                context,
+                package_dict,
+                harvest_object.harvest_job_id
+            )
 
             Session.commit()
 
+            _id_cache.log_stats()
             log.debug('Importing finished.')
         except Exception, e:
             log.exception(e)
+            # only this object fails, the session is usable for the next
+            Session.rollback()
+            # look the ids up again in case one of them became stale
+            _id_cache.invalidate()
             self._save_object_error(
                 'Exception when importing object: %s' % e,
                 harvest_object
             )
             return False
+
+        if self._batch_size:
+            self._batch_package_ids.append(package_dict['id'])
+            if len(self._batch_package_ids) >= self._batch_size:
+                self._index_batch()
         return True
 
+    def _get_harvest_user_id(self):
+        user = model.User.get(self.HARVEST_USER)
+        if user is None:
+            return None
+        return user.id
+
     def _find_or_create_groups(self, context):
         group_name = self.GROUPS['de'][0]
         data_dict = {
@@ -255,7 +547,7 @@ class SNLHarvester(HarvesterBase):
             }
         try:
             group = get_action('group_show')(context, data_dict)
-        except:
+        except NotFound:
             group = get_action('group_create')(context, data_dict)
             log.info('created the group ' + group['id'])
         group_ids = []
@@ -278,7 +570,7 @@ class SNLHarvester(HarvesterBase):
         }
         try:
             organization = get_action('organization_show')(context, data_dict)
-        except:
+        except NotFound:
             organization = get_action('organization_create')(
                 context,
                 data_dict
@@ -316,6 +608,53 @@ class SNLHarvester(HarvesterBase):
             log.exception(e)
             return []
 
-    def _submit_term_translations(self, context, package_dict):
-        for translation in package_dict['translations']:
-            action.update.term_translation_update(context, translation)
+    def _submit_term_translations(self, context, package_dict, job_id):
+        '''
+        Submit the translations of a dataset and of the organization and
+        group in one bulk update. Translations already submitted during
+        the job or stored with the same value are skipped.
+        '''
+        if job_id not in _submitted_translations:
+            # only remember the translations of the current job
+            _submitted_translations.clear()
+            _submitted_translations[job_id] = {}
+        submitted = _submitted_translations[job_id]
+
+        # the last translation of a term wins, as with single updates
+        pending = OrderedDict()
+        for translation in (package_dict['translations'] +
+                            self._metadata_term_translations()):
+            key = (translation['term'], translation['lang_code'])
+            if submitted.get(key) == translation['term_translation']:
+                pending.pop(key, None)
+            else:
+                pending[key] = translation
+        total = len(pending)
+
+        if pending:
+            stored = action.get.term_translation_show(
+                dict(context),
+                {
+                    'terms': list(set(term for term, lang in pending)),
+                    'lang_codes': list(set(lang for term, lang in pending))
+                }
+            )
+            for row in stored:
+                key = (row['term'], row['lang_code'])
+                if (key in pending and pending[key]['term_translation'] ==
+                        row['term_translation']):
+                    submitted[key] = row['term_translation']
+                    del pending[key]
+
+        if pending:
+            # update_many sets defer_commit in the context it gets
+            action.update.term_translation_update_many(
+                dict(context),
+                {'data': pending.values()}
+            )
+            for key, translation in pending.iteritems():
+                submitted[key] = translation['term_translation']
+        log.debug(
+            'Submitted %d of %d new term translations, %d unchanged'
+            % (len(pending), total, total - len(pending))
+        )
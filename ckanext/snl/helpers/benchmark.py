@@ -0,0 +1,86 @@
+from lxml import etree
+from xml_metadata import MetaDataParser
+import os
+import shutil
+import tempfile
+import time
+import logging
+log = logging.getLogger(__name__)
+
+LANGS = ('de', 'fr', 'it', 'en')
+
+
+def _add_attribute(parent, name, texts):
+    attribute = etree.SubElement(parent, name)
+    for lang, text in zip(LANGS, texts):
+        etree.SubElement(attribute, lang).text = text
+
+
+def write_metadata_file(path, dataset_count, resource_count=3):
+    '''
+    Write a synthetic metadata file with the structure of
+    OGD_Metadaten_NB.xml
+    '''
+    with open(path, 'w') as outfile:
+        outfile.write('<?xml version="1.0" encoding="utf-8"?>\n<datasets>\n')
+        for i in range(dataset_count):
+            dataset = etree.Element('dataset', id='dataset-%d' % i)
+            attrs = etree.SubElement(dataset, 'dataset_attributes')
+            for attr in MetaDataParser.DATASET_ATTRIBUTES:
+                if attr == 'tags':
+                    texts = [
+                        u'tag%d-%s, thema-%s, bibliothek' % (i, lang, lang)
+                        for lang in LANGS
+                    ]
+                elif attr in ('append_data', 'license_id', 'bucket_prefix'):
+                    texts = [u'%s-%d' % (attr, i % 2)] * len(LANGS)
+                else:
+                    texts = [u'%s %d (%s)' % (attr, i, lang) for lang in LANGS]
+                _add_attribute(attrs, attr, texts)
+            for j in range(resource_count):
+                resource = etree.SubElement(dataset, 'resource')
+                res_attrs = etree.SubElement(resource, 'resource_attributes')
+                for attr in MetaDataParser.RESOURCE_ATTRIBUTES:
+                    texts = [
+                        u'%s %d.%d (%s)' % (attr, i, j, lang)
+                        for lang in LANGS
+                    ]
+                    _add_attribute(res_attrs, attr, texts)
+            outfile.write(etree.tostring(dataset, encoding='utf-8'))
+            outfile.write('\n')
+        outfile.write('</datasets>')
+
+
+def benchmark_metadata_parser(dataset_count=5000, repeat=3):
+    '''
+    Time parsing a synthetic metadata file with MetaDataParser and
+    return the best run in seconds
+    '''
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'metadata.xml')
+        write_metadata_file(path, dataset_count)
+        log.info(
+            'Parsing %d datasets (%.1f MB)'
+            % (dataset_count, os.stat(path).st_size / 1048576.0)
+        )
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            parser = MetaDataParser(path)
+            translations = 0
+            for dataset in parser.list_datasets():
+                translations += len(parser.parse_set(dataset)['translations'])
+            timings.append(time.time() - start)
+            log.info(
+                'Run %d: %.2fs, %.0f datasets/s, %d translations'
+                % (
+                    i + 1,
+                    timings[-1],
+                    dataset_count / timings[-1],
+                    translations
+                )
+            )
+        return min(timings)
+    finally:
+        shutil.rmtree(temp_dir)
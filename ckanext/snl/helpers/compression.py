@@ -0,0 +1,52 @@
+import zlib
+
+# Window bits that make zlib write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gzip_member(data, level=6):
+    '''
+    Compress data as a single gzip member
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipStream(object):
+    '''
+    Compresses the data written to it in gzip format and writes the result
+    to another stream.
+
+    end_member() finishes the current gzip member, the following data
+    starts a new one. gzip readers decompress concatenated members as one
+    file, so a trailing member can be replaced later to append data.
+    '''
+    def __init__(self, stream, level=6):
+        self.stream = stream
+        self.level = level
+        self._compressor = None
+
+    def _write(self, data):
+        if data:
+            self.stream.write(data)
+
+    def write(self, data):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(
+                self.level,
+                zlib.DEFLATED,
+                GZIP_WBITS
+            )
+        self._write(self._compressor.compress(data))
+
+    def end_member(self):
+        if self._compressor is not None:
+            self._write(self._compressor.flush())
+            self._compressor = None
+
+    def close(self):
+        self.end_member()
+        self.stream.close()
+
+    def cancel(self, abort=True):
+        self.stream.cancel(abort)
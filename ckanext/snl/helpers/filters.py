@@ -0,0 +1,110 @@
+import re
+from lxml import etree
+import logging
+log = logging.getLogger(__name__)
+
+MARC_NAMESPACES = {
+    'marc': 'http://www.loc.gov/MARC21/slim',
+}
+
+# <tag>[$<subfield code>][=<value>[,<value>...]], e.g. 993$a=sb, values
+# of data fields need a subfield code, control fields (00X) have none
+FILTER_SPEC = re.compile(
+    r'^(?P<tag>[0-9A-Za-z]{3})'
+    r'(?:\$(?P<code>[0-9a-z]))?'
+    r'(?:=(?P<values>.*))?$'
+)
+
+
+class InvalidFilterError(Exception):
+    pass
+
+
+class RecordFilter(object):
+    '''
+    Keeps the MARC records whose first matching control field or
+    subfield has one of the given values. Without values every record
+    that has the field is kept.
+
+    The XPath expression is compiled once, so one instance should be
+    used for all records of an export.
+    '''
+    def __init__(self, tag, code=None, values=None):
+        self.tag = tag
+        self.code = code
+        self.values = frozenset(values or [])
+        if tag.startswith('00'):
+            path = ".//marc:controlfield[@tag=$tag]"
+        else:
+            path = ".//marc:datafield[@tag=$tag]"
+        if code is not None:
+            path += "/marc:subfield[@code=$code]"
+        self._xpath = etree.XPath(path, namespaces=MARC_NAMESPACES)
+        self.kept = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        '''
+        Create a filter from a spec like 993$a=sb,sbx
+        '''
+        match = FILTER_SPEC.match(spec.strip())
+        if match is None:
+            raise InvalidFilterError('Invalid record filter: %s' % spec)
+        # a filter that can never match would empty the export
+        control_field = match.group('tag').startswith('00')
+        if (control_field and match.group('code') is not None):
+            raise InvalidFilterError(
+                'Control field %s has no subfields: %s'
+                % (match.group('tag'), spec)
+            )
+        if (not control_field and match.group('code') is None and
+                match.group('values') is not None):
+            raise InvalidFilterError(
+                'Values of data field %s need a subfield code: %s'
+                % (match.group('tag'), spec)
+            )
+        values = None
+        if match.group('values') is not None:
+            values = [
+                x.strip() for x in match.group('values').split(',')
+                if x.strip()
+            ]
+        return cls(match.group('tag'), match.group('code'), values)
+
+    def __str__(self):
+        spec = self.tag
+        if self.code is not None:
+            spec += '$' + self.code
+        if self.values:
+            spec += '=' + ','.join(sorted(self.values))
+        return spec
+
+    def _matches(self, metadata):
+        if metadata is None:
+            return False
+        if self.code is None:
+            fields = self._xpath(metadata, tag=self.tag)
+        else:
+            fields = self._xpath(metadata, tag=self.tag, code=self.code)
+        if not fields:
+            return False
+        if not self.values:
+            return True
+        return fields[0].text in self.values
+
+    def __call__(self, metadata):
+        '''
+        Return True if the record is kept
+        '''
+        if self._matches(metadata):
+            self.kept += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def log_counts(self, set_name):
+        log.info(
+            'Record filter %s on set %s: kept %d, rejected %d records'
+            % (self, set_name, self.kept, self.rejected)
+        )
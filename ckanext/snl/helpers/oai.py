@@ -1,25 +1,165 @@
-from oaipmh.client import Client
 from oaipmh.metadata import MetadataRegistry, oai_dc_reader
 from metadata import XMLMetadataReader
 from oaipmh.server import oai_dc_writer
+from oaipmh import error
+from oaipmh.datestamp import datestamp_to_datetime, datetime_to_datestamp
 from lxml import etree
 from resumption import ResumptionClient
+from pylons import config
 import os
 import tempfile
 import shutil
 import datetime
-import s3
+import json
+import threading
+import storage
+import workdir
+from compression import GzipStream, gzip_member
+from filters import RecordFilter
 import logging
 log = logging.getLogger(__name__)
 
+# serializes the updates of the harvest state files within the process
+_harvest_state_lock = threading.Lock()
+
+COMPRESSION_FORMATS = ('gzip', 'none')
+
+
+class UnknownCompressionError(Exception):
+    pass
+
+
+def compression_enabled():
+    '''
+    Return True if a gzip compressed copy of the exports is written
+    (ckanext.snl.export_compression = gzip or none, default gzip)
+    '''
+    compression = config.get('ckanext.snl.export_compression', 'gzip')
+    if compression not in COMPRESSION_FORMATS:
+        raise UnknownCompressionError(
+            "Unknown export compression '%s', use one of %s"
+            % (compression, ', '.join(COMPRESSION_FORMATS))
+        )
+    return compression == 'gzip'
+
+
+class ExportSink(object):
+    '''
+    Streams an export file to S3 and, if compress is set, a gzip compressed
+    copy of it in the same pass.
+
+    checkpoint() is taken when the export file completed a part. It is
+    only valid once all parts before it are uploaded (see is_uploaded),
+    then save() writes the still buffered data of the compressed copy to
+    the work directory and returns the state to resume the uploads from.
+    '''
+    def __init__(self, uploads, work_dir, compress=False):
+        self.uploads = uploads
+        self.work_dir = work_dir
+        self.closed = set()
+        self.compressed = None
+        if compress:
+            self.compressed = GzipStream(uploads[1][1])
+
+    def write(self, data):
+        '''
+        Write data and return True if the export file completed a part
+        '''
+        completed_part = self.uploads[0][1].write(data)
+        if self.compressed is not None:
+            self.compressed.write(data)
+        return completed_part
+
+    def checkpoint(self):
+        if self.compressed is not None:
+            self.compressed.end_member()
+        return dict(
+            (name, {
+                'upload_id': upload.upload_id,
+                'part_count': upload.part_count,
+                'pending': upload.get_pending(),
+            })
+            for name, upload in self.uploads
+        )
+
+    def is_uploaded(self, checkpoint):
+        return all(
+            upload.is_uploaded(checkpoint[name]['part_count'])
+            for name, upload in self.uploads
+        )
+
+    def save(self, checkpoint, tag):
+        state = {}
+        for name, upload in self.uploads:
+            pending_file = None
+            if checkpoint[name]['pending']:
+                pending_file = '%s.%s.pending' % (name, tag)
+                path = os.path.join(self.work_dir, pending_file)
+                with open(path, 'w') as outfile:
+                    outfile.write(checkpoint[name]['pending'])
+            state[name] = {
+                'upload_id': upload.upload_id,
+                'etags': upload.get_etags(checkpoint[name]['part_count']),
+                'pending': pending_file,
+            }
+        return state
+
+    def remove_pending_files(self, state):
+        '''
+        Remove the pending files that are not part of state
+        '''
+        keep = [x['pending'] for x in state.values()]
+        for filename in os.listdir(self.work_dir):
+            if filename.endswith('.pending') and filename not in keep:
+                os.remove(os.path.join(self.work_dir, filename))
+
+    def close(self, footer, completed=None):
+        '''
+        Write the footer, as a gzip member of its own in the compressed
+        copy, and complete the uploads. The export file is completed
+        first, completed() is called right after it.
+        '''
+        self.uploads[0][1].write(footer)
+        if self.compressed is not None:
+            self.compressed.end_member()
+            self.compressed.write(footer)
+            self.compressed.end_member()
+        for name, upload in self.uploads:
+            upload.close()
+            self.closed.add(name)
+            if (completed is not None and name == self.uploads[0][0]):
+                completed()
+
+    def cancel(self, abort=True):
+        # completed uploads cannot be cancelled anymore
+        for name, upload in self.uploads:
+            if name not in self.closed:
+                upload.cancel(abort)
+
 
 class OAI():
 
+    HEADER = '<records>\n'
+    FOOTER = '</records>'
+
+    # Keeps the datestamp of the latest harvested records and their
+    # identifiers per metadata prefix
+    HARVEST_STATE_FILE = 'harvest_state.json'
+
+    # Checkpoint of a running export in its work directory
+    MANIFEST_FILE = 'manifest.json'
+
     def __init__(
             self,
             bucket_prefix,
             url='http://opac.admin.ch/cgi-bin/nboai/VTLS/Vortex.pl',
-            metadata_prefix='marcxml'):
+            metadata_prefix='marcxml',
+            export_storage=None,
+            transport=None):
+        '''
+        export_storage and transport can be shared by several instances,
+        e.g. to export the resources of a dataset concurrently
+        '''
         self.registry = MetadataRegistry()
         self.url = url
 
@@ -34,8 +174,13 @@ class OAI():
         else:
             log.debug('Metadata format not marcxml or oai_dc')
 
-        self.client = Client(self.url, self.registry)
-        self.s3 = s3.S3()
+        self.client = ResumptionClient(
+            self.url,
+            metadata_prefix,
+            self.registry,
+            transport=transport
+        )
+        self.storage = export_storage or storage.get_storage()
         self.bucket_prefix = bucket_prefix
 
     def _concatenate_xml_files(
@@ -54,25 +199,198 @@ class OAI():
             if wrap is not None:
                 outfile.write('</' + wrap + '>')
 
-    def _upload_dir_content_to_s3(self, set_name, dir_name):
+    def _sync_dir_content_to_s3(self, set_name, dir_name):
         bucket_name = self.bucket_prefix + '.' + set_name
-        self.s3.upload_dir_to_bucket(bucket_name, dir_name)
+        self.storage.sync_dir_to_bucket(bucket_name, dir_name)
 
-    def _upload_file_to_s3(self, set_name, dir_name, filename):
+    def _upload_file_to_s3(self, set_name, dir_name, filename,
+                           compress=False):
         bucket_name = self.bucket_prefix + '.' + set_name
-        self.s3.upload_file_to_bucket(bucket_name, dir_name, filename)
+        self.storage.upload_file_to_bucket(
+            bucket_name,
+            dir_name,
+            filename,
+            compress=compress,
+            footer=self.FOOTER
+        )
+
+    def _export_filenames(self, export_filename, compress):
+        if compress:
+            return [export_filename, export_filename + '.gz']
+        return [export_filename]
+
+    def _open_export_sink(self, set_name, filenames, work_dir, state=None):
+        bucket_name = self.bucket_prefix + '.' + set_name
+        uploads = []
+        for filename in filenames:
+            if state is None:
+                upload = self.storage.open_upload_stream(bucket_name, filename)
+            else:
+                pending = None
+                if state[filename]['pending']:
+                    path = os.path.join(work_dir, state[filename]['pending'])
+                    with open(path) as infile:
+                        pending = infile.read()
+                upload = self.storage.open_upload_stream(
+                    bucket_name,
+                    filename,
+                    state[filename]['upload_id'],
+                    state[filename]['etags'],
+                    pending
+                )
+            uploads.append((filename, upload))
+        return ExportSink(uploads, work_dir, len(filenames) > 1)
+
+    def _has_uploads(self, set_name, filenames, checkpoint):
+        bucket_name = self.bucket_prefix + '.' + set_name
+        state = checkpoint.get('uploads', {})
+        for filename in filenames:
+            if filename not in state:
+                return False
+            if not self.storage.has_multipart_upload(
+                    bucket_name,
+                    filename,
+                    state[filename]['upload_id']):
+                return False
+        return True
 
     def _dump_s3_bucket_to_dir(self, set_name, dir_name, ignore=None):
         prefix = self.bucket_prefix + '.' + set_name + '/'
-        return self.s3.download_bucket_to_dir(prefix, dir_name, ignore)
+        return self.storage.download_bucket_to_dir(prefix, dir_name, ignore)
 
     def _get_url_of_file(self, set_name, filename):
         bucket_name = self.bucket_prefix + '.' + set_name
-        return self.s3.get_url_of_file(bucket_name, filename)
+        return self.storage.get_url_of_file(bucket_name, filename)
 
     def get_size_of_file(self, set_name, filename):
         bucket_name = self.bucket_prefix + '.' + set_name
-        return self.s3.get_size_of_file(bucket_name, filename)
+        return self.storage.get_size_of_file(bucket_name, filename)
+
+    def get_compressed_file(self, set_name, filename):
+        '''
+        Return URL and size of the gzip compressed copy of an export file
+        '''
+        bucket_name = self.bucket_prefix + '.' + set_name
+        return (
+            self.storage.get_url_of_file(bucket_name, filename + '.gz'),
+            self.storage.get_size_of_file(bucket_name, filename + '.gz')
+        )
+
+    def _get_harvest_state(self, set_name):
+        bucket_name = self.bucket_prefix + '.' + set_name
+        content = self.storage.get_contents_of_file(
+            bucket_name,
+            self.HARVEST_STATE_FILE
+        )
+        if content is None:
+            return {}
+        try:
+            return json.loads(content)
+        except ValueError:
+            log.warning('Ignoring invalid harvest state of set %s' % set_name)
+            return {}
+
+    def _save_harvest_state(self, set_name, state):
+        bucket_name = self.bucket_prefix + '.' + set_name
+        self.storage.upload_string_to_bucket(
+            bucket_name,
+            self.HARVEST_STATE_FILE,
+            json.dumps(state)
+        )
+
+    def _get_harvest_mark(self, set_name, metadata_prefix):
+        '''
+        Return the datestamp of the latest harvested records and the set
+        of their identifiers, (None, set()) if the set was not harvested
+        '''
+        state = self._get_harvest_state(set_name)
+        try:
+            datestamp = datestamp_to_datetime(
+                state[metadata_prefix]['last_datestamp']
+            )
+        except (KeyError, TypeError, ValueError):
+            return None, set()
+        return datestamp, set(state[metadata_prefix].get('identifiers', []))
+
+    def _save_harvest_mark(self, set_name, metadata_prefix, datestamp,
+                           identifiers):
+        # the state of all metadata prefixes of a set is kept in one file
+        with _harvest_state_lock:
+            state = self._get_harvest_state(set_name)
+            state[metadata_prefix] = {
+                'last_datestamp': datetime_to_datestamp(datestamp),
+                'identifiers': sorted(identifiers),
+            }
+            self._save_harvest_state(set_name, state)
+
+    def _update_granularity(self):
+        try:
+            self.client.updateGranularity()
+        except Exception, e:
+            # every OAI-PMH repository supports day granularity
+            log.debug('Could not get granularity, use days: %s' % e)
+            self.client._day_granularity = True
+
+    def _to_datestamp(self, value):
+        if value is None:
+            return None
+        return datetime_to_datestamp(value)
+
+    def _to_datetime(self, value):
+        if value is None:
+            return None
+        return datestamp_to_datetime(value)
+
+    def _get_work_dir(self, set_name, export_filename):
+        return workdir.get_work_dir(
+            'export',
+            self.bucket_prefix + '.' + set_name,
+            export_filename
+        )
+
+    def _save_checkpoint(self, work_dir, checkpoint):
+        manifest = os.path.join(work_dir, self.MANIFEST_FILE)
+        with open(manifest + '.tmp', 'w') as manifest_file:
+            json.dump(checkpoint, manifest_file)
+        os.rename(manifest + '.tmp', manifest)
+        log.debug(
+            'Saved checkpoint at record %s to %s'
+            % (checkpoint['count'], manifest)
+        )
+
+    def _load_checkpoint(self, work_dir, metadata_prefix, append):
+        '''
+        Return the checkpoint of a failed export in work_dir, and remove
+        all files that were written after it
+        '''
+        checkpoint = None
+        manifest = os.path.join(work_dir, self.MANIFEST_FILE)
+        try:
+            with open(manifest) as manifest_file:
+                checkpoint = json.load(manifest_file)
+            if (checkpoint['metadata_prefix'] != metadata_prefix or
+                    checkpoint['append'] != append):
+                log.info('Ignoring checkpoint of a different export')
+                checkpoint = None
+        except IOError:
+            pass
+        except (ValueError, KeyError):
+            log.warning('Ignoring invalid checkpoint %s' % manifest)
+            checkpoint = None
+
+        keep = []
+        if checkpoint is not None:
+            keep = [self.MANIFEST_FILE] + checkpoint['step_files']
+            keep.extend(
+                x['pending'] for x in checkpoint.get('uploads', {}).values()
+            )
+        self._clear_work_dir(work_dir, keep)
+        return checkpoint
+
+    def _clear_work_dir(self, work_dir, keep=()):
+        for filename in os.listdir(work_dir):
+            if filename not in keep:
+                os.remove(os.path.join(work_dir, filename))
 
     def dump(self, set_name):
         temp_dir = tempfile.mkdtemp()
@@ -86,10 +404,49 @@ class OAI():
             count=0,
             limit=None,
             export_filename='records.xml',
-            metadata_prefix='marcxml'):
+            metadata_prefix='marcxml',
+            compress=None,
+            record_filter=None):
         log.debug('Starting to export set %s' % set_name)
+        if compress is None:
+            compress = compression_enabled()
         log.debug('oai_url: ' + self.url)
         actual_set_name = set_name
+        last_datestamp = None
+        last_identifiers = set()
+        latest_datestamp = None
+        latest_identifiers = set()
+        checkpoint = None
+        composed = False
+        skip = 0
+
+        # only complete exports are checkpointed and resumed automatically
+        resumable = (params is None and limit is None)
+        if resumable:
+            work_dir = self._get_work_dir(set_name, export_filename)
+            checkpoint = self._load_checkpoint(
+                work_dir,
+                metadata_prefix,
+                append
+            )
+        else:
+            work_dir = tempfile.mkdtemp()
+        log.debug('Work directory: %s' % work_dir)
+
+        # complete exports that replace the data are streamed to S3
+        # instead of being staged as step files
+        stream = (resumable and not append)
+        stream_filenames = self._export_filenames(export_filename, compress)
+        if (stream and checkpoint is not None and
+                not self._has_uploads(set_name, stream_filenames, checkpoint)):
+            log.warning(
+                'Upload of the checkpoint is gone, export of set %s '
+                'starts from the beginning' % set_name
+            )
+            # without its manifest a failure of this export aborts the
+            # new uploads instead of keeping them for the old checkpoint
+            self._clear_work_dir(work_dir)
+            checkpoint = None
 
         if params is None:
             actual_set_name = set_name if not append else 'NewBib'
@@ -98,62 +455,165 @@ class OAI():
                 'metadataPrefix': metadata_prefix,
             }
 
-        filenames = []
+            # only ask for records changed since the last harvest
+            if checkpoint is not None:
+                last_datestamp = self._to_datetime(
+                    checkpoint['last_datestamp']
+                )
+                last_identifiers = set(
+                    checkpoint.get('last_identifiers', [])
+                )
+            elif (append and limit is None):
+                last_datestamp, last_identifiers = self._get_harvest_mark(
+                    set_name,
+                    metadata_prefix
+                )
+            if last_datestamp is not None:
+                log.debug('Harvesting records since %s' % last_datestamp)
+                self._update_granularity()
+                params['from_'] = last_datestamp
+
+        # the records of a set are taken from NewBib by their field 993
+        if record_filter is not None:
+            record_filter = RecordFilter.from_spec(record_filter)
+        elif (actual_set_name != set_name and set_name != 'NewBib'):
+            record_filter = RecordFilter('993', 'a', [set_name])
+
+        start_count = count
+        records = []
         step_files = []
-        temp_dir = tempfile.mkdtemp()
-        log.debug('Temporary directory created: %s' % temp_dir)
+        rec_iter = None
+        sink = None
+        pending_checkpoint = None
+        success = False
+
+        def current_checkpoint():
+            return {
+                'metadata_prefix': metadata_prefix,
+                'append': append,
+                'token': rec_iter.page_token,
+                'position': rec_iter.page_position,
+                'start_count': start_count,
+                'count': count,
+                'step_files': [os.path.basename(x) for x in step_files],
+                'last_datestamp': self._to_datestamp(last_datestamp),
+                'last_identifiers': sorted(last_identifiers),
+                'latest_datestamp': self._to_datestamp(latest_datestamp),
+                'latest_identifiers': sorted(latest_identifiers),
+            }
+
+        def save_composed():
+            # a resumed export must not append the step files again, it
+            # only completes the compressed copy and the harvest mark
+            if checkpoints:
+                composed_checkpoint = current_checkpoint()
+                composed_checkpoint['composed'] = True
+                self._save_checkpoint(work_dir, composed_checkpoint)
 
         try:
-            if (append and limit is None):
-                log.debug('Copy content from bucket to append new data...')
-                step_files = self._dump_s3_bucket_to_dir(
-                    set_name,
-                    temp_dir,
-                    ignore=[export_filename]
+            if checkpoint is not None:
+                log.info(
+                    'Resuming export of set %s at record %s'
+                    % (set_name, checkpoint['count'])
+                )
+                start_count = checkpoint['start_count']
+                count = checkpoint['count']
+                latest_datestamp = self._to_datetime(
+                    checkpoint['latest_datestamp']
                 )
+                latest_identifiers = set(
+                    checkpoint.get('latest_identifiers', [])
+                )
+                step_files = [
+                    os.path.join(work_dir, x)
+                    for x in checkpoint['step_files']
+                ]
+                if checkpoint['token'] is not None:
+                    params = {'resumptionToken': checkpoint['token']}
+                skip = checkpoint['position']
+                composed = checkpoint.get('composed', False)
 
-                # remove all files that are not step files
-                step_files = [x for x in step_files if x.endswith('.xml_part')]
+            if stream:
+                if checkpoint is not None:
+                    sink = self._open_export_sink(
+                        set_name,
+                        stream_filenames,
+                        work_dir,
+                        checkpoint['uploads']
+                    )
+                else:
+                    sink = self._open_export_sink(
+                        set_name,
+                        stream_filenames,
+                        work_dir
+                    )
+                    sink.write(self.HEADER)
 
             log.debug('Params: %s' % params)
-            rec_iter = iter(self.client.listRecords(**params))
+            try:
+                if composed:
+                    log.info(
+                        'Export file of set %s is already composed'
+                        % set_name
+                    )
+                    rec_iter = (record for record in ())
+                else:
+                    rec_iter = iter(self.client.listRecords(**params))
+            except error.BadResumptionTokenError:
+                log.error(
+                    'Resumption token of checkpoint expired, the next '
+                    'export of set %s starts from the beginning' % set_name
+                )
+                os.remove(os.path.join(work_dir, self.MANIFEST_FILE))
+                raise
+            except error.NoRecordsMatchError:
+                log.info('No new records in set %s' % actual_set_name)
+                rec_iter = (record for record in ())
+            checkpoints = (resumable and hasattr(rec_iter, 'page_token'))
             while True:
+                # errors while fetching abort the export and keep the
+                # checkpoint, so that the next export continues from there
                 try:
                     header, metadata, about = rec_iter.next()
-                    # check if we use NewBib to add only new entries
-                    if (actual_set_name != set_name and set_name != 'NewBib'):
-                        try:
-                            xml_namespaces = {
-                                'marc': 'http://www.loc.gov/MARC21/slim',
-                            }
-                            record_type = etree.XPath(
-                                (
-                                    ".//marc:datafield[@tag='993']"
-                                    "/marc:subfield[@code='a']"
-                                ),
-                                namespaces=xml_namespaces
-                            )
-                            if record_type(metadata)[0].text != set_name:
-                                log.debug(
-                                    'Record does not belong to set %s'
-                                    % set_name
-                                )
-                                continue
-                        except (IndexError, TypeError):
-                            log.debug(
-                                'Record does not belong to set %s' %
-                                (set_name)
-                            )
-                            continue
-
-                    count += 1
-                    today = datetime.date.today().strftime("%Y-%m-%d")
-                    log.debug(
-                        'Fetching record %s from set %s: %s'
-                        % (count, set_name, header.identifier())
-                    )
+                except StopIteration:
+                    break
 
-                    # save record as XML file
+                # skip the records the checkpoint already contains
+                if skip:
+                    skip -= 1
+                    continue
+
+                # only errors of a single record skip it, errors while
+                # writing abort the export and keep the checkpoint
+                try:
+                    # the from argument includes the records of the last
+                    # harvest, records added later with the same datestamp
+                    # are told apart by their identifier
+                    datestamp = header.datestamp()
+                    identifier = header.identifier()
+                    if (last_datestamp is not None and
+                            (datestamp < last_datestamp or
+                             (datestamp == last_datestamp and
+                              identifier in last_identifiers))):
+                        log.debug(
+                            'Record %s was already harvested' % identifier
+                        )
+                        continue
+                    if (latest_datestamp is None or
+                            datestamp > latest_datestamp):
+                        latest_datestamp = datestamp
+                        latest_identifiers = set([identifier])
+                    elif datestamp == latest_datestamp:
+                        latest_identifiers.add(identifier)
+
+                    if (record_filter is not None and
+                            not record_filter(metadata)):
+                        log.debug(
+                            'Record does not belong to set %s' % set_name
+                        )
+                        continue
+
+                    # serialize record into the buffer of the current step
                     newRecord = etree.Element("record")
                     if metadata_prefix == 'marcxml':
                         newRecord.append(metadata)
@@ -163,91 +623,346 @@ class OAI():
                             newRecord,
                             metadata
                         )
-                    tree = etree.ElementTree(newRecord)
-                    filename = os.path.join(temp_dir,
-                                            header.identifier() + '.xml')
-                    filenames.append(filename)
-                    tree.write(filename, pretty_print=True)
-
-                    if (count % 500 == 0):
-                        log.debug('Create step file %s' % count)
-                        step_files.append(
-                            self._create_step_file(
-                                str(count) + '_' + today,
-                                temp_dir,
-                                set_name, filenames
-                            )
+                    record = etree.tostring(newRecord, pretty_print=True)
+                except Exception, e:
+                    log.warning(
+                        'Skipping record %s of set %s: %s'
+                        % (header.identifier(), set_name, e)
+                    )
+                    continue
+
+                count += 1
+                log.debug(
+                    'Fetched record %s from set %s: %s'
+                    % (count, set_name, identifier)
+                )
+                records.append(record)
+
+                if (count % 500 == 0 and stream):
+                    log.debug('Stream step %s to S3' % count)
+                    # a checkpoint is only valid once all parts
+                    # before it are uploaded, it is kept until then even
+                    # if more parts are completed in the meantime
+                    if (sink.write(''.join(records)) and checkpoints and
+                            pending_checkpoint is None):
+                        pending_checkpoint = current_checkpoint()
+                        pending_checkpoint['uploads'] = sink.checkpoint()
+                    records = []
+
+                    if (pending_checkpoint is not None and
+                            sink.is_uploaded(pending_checkpoint['uploads'])):
+                        pending_checkpoint['uploads'] = sink.save(
+                            pending_checkpoint['uploads'],
+                            pending_checkpoint['count']
+                        )
+                        self._save_checkpoint(work_dir, pending_checkpoint)
+                        sink.remove_pending_files(
+                            pending_checkpoint['uploads']
                         )
-                        filenames = []
+                        pending_checkpoint = None
+                elif (count % 500 == 0):
+                    log.debug('Create step file %s' % count)
+                    today = datetime.date.today().strftime("%Y-%m-%d")
+                    step_files.append(
+                        self._create_step_file(
+                            str(count) + '_' + today,
+                            work_dir,
+                            set_name, records
+                        )
+                    )
+                    records = []
 
-                    if (limit is not None and count >= limit):
-                        break
+                    if checkpoints:
+                        self._save_checkpoint(work_dir, current_checkpoint())
 
-                except StopIteration:
+                if (limit is not None and count >= limit):
                     break
-                except Exception, e:
-                    log.debug(e)
-                    pass
 
-            if filenames:
+            # stops the prefetching of further pages and logs the timings
+            rec_iter.close()
+            if record_filter is not None:
+                record_filter.log_counts(set_name)
+
+            if stream:
+                if count > start_count:
+                    sink.write(''.join(records))
+                    sink.close(self.FOOTER)
+                else:
+                    sink.cancel()
+                success = True
+                return self._get_url_of_file(set_name, export_filename)
+
+            if records:
                 today = datetime.date.today().strftime("%Y-%m-%d")
                 log.debug('Create step file %s' % count)
                 step_files.append(
                     self._create_step_file(
                         str(count) + '_' + today,
-                        temp_dir,
+                        work_dir,
                         set_name,
-                        filenames
+                        records
                     )
                 )
 
-                if (limit is not None):
-                    return step_files
-
-                record_filename = os.path.join(temp_dir, export_filename)
-                log.debug('Record file: %s' % record_filename)
-                self._concatenate_xml_files(record_filename, step_files)
+            if (limit is not None):
+                success = True
+                return step_files
 
-                if (append):
-                    log.debug('Uploading dir %s to S3' % temp_dir)
-                    self._upload_dir_content_to_s3(set_name, temp_dir)
+            if count > start_count:
+                if (append and composed):
+                    if compress:
+                        self._compress_export(
+                            set_name,
+                            work_dir,
+                            export_filename
+                        )
+                elif (append):
+                    self._append_to_s3(
+                        set_name,
+                        work_dir,
+                        export_filename,
+                        step_files,
+                        compress,
+                        save_composed
+                    )
                 else:
+                    record_filename = os.path.join(work_dir, export_filename)
+                    log.debug('Record file: %s' % record_filename)
+                    self._concatenate_xml_files(record_filename, step_files)
                     log.debug(
                         'Uploading %s from %s to S3'
-                        % (export_filename, temp_dir)
+                        % (export_filename, work_dir)
                     )
                     self._upload_file_to_s3(
                         set_name,
-                        temp_dir,
-                        export_filename
+                        work_dir,
+                        export_filename,
+                        compress
                     )
+
+            # latest_datestamp is only set by records that were not
+            # harvested before, the mark also moves past the records the
+            # filter rejected, so that they are not listed again
+            if (append and latest_datestamp is not None):
+                if latest_datestamp == last_datestamp:
+                    latest_identifiers |= last_identifiers
+                self._save_harvest_mark(
+                    set_name,
+                    metadata_prefix,
+                    latest_datestamp,
+                    latest_identifiers
+                )
+            success = True
         finally:
-            log.debug('Deleting directory ' + temp_dir)
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception, e:
-                log.exception(e)
-                pass
+            if rec_iter is not None:
+                rec_iter.close()
+            has_checkpoint = os.path.exists(
+                os.path.join(work_dir, self.MANIFEST_FILE)
+            )
+            if (sink is not None and not success):
+                # keep the multipart uploads the checkpoint refers to
+                sink.cancel(abort=not has_checkpoint)
+            if (resumable and not success and has_checkpoint):
+                log.error(
+                    'Export of set %s failed, the next export resumes '
+                    'from the checkpoint in %s' % (set_name, work_dir)
+                )
+            else:
+                log.debug('Deleting directory ' + work_dir)
+                try:
+                    shutil.rmtree(work_dir)
+                except Exception, e:
+                    log.exception(e)
+                    pass
 
         return self._get_url_of_file(set_name, export_filename)
 
-    def _create_step_file(self, step_name, dir_name, set_name, filenames):
-            step_file = os.path.join(
+    def _append_to_s3(self, set_name, dir_name, export_filename, step_files,
+                      compress=False, composed=None):
+        '''
+        Upload the new step files and append them to the export file (and
+        its compressed copy).
+
+        The new export file is composed on S3 from the existing one if
+        possible, only if that fails all step files are downloaded and
+        concatenated locally. A compressed copy that is too small to be
+        composed on S3 is rebuilt from its old version and the new step
+        files.
+
+        composed() is called as soon as the export file is replaced,
+        before its compressed copy is completed.
+        '''
+        bucket_name = self.bucket_prefix + '.' + set_name
+        upload = self.storage.open_append_stream(
+            bucket_name,
+            export_filename,
+            self.FOOTER
+        )
+        if upload is None:
+            log.debug('Copy content from bucket to append new data...')
+            old_step_files = self._dump_s3_bucket_to_dir(
+                set_name,
                 dir_name,
-                set_name + '_' + step_name + '.xml_part'
+                ignore=[
+                    export_filename,
+                    export_filename + '.gz',
+                    self.HARVEST_STATE_FILE,
+                    self.MANIFEST_FILE
+                ]
             )
-            self._concatenate_xml_files(step_file, filenames, wrap=None)
-            for filename in filenames:
-                try:
-                    os.remove(filename)
-                    log.debug('Deleted file %s' % (filename))
-                except OSError:
-                    log.debug('Could not delete file %s' % (filename))
-            return step_file
+
+            # remove all files that are not step files
+            old_step_files = [
+                x for x in old_step_files
+                if x.endswith('.xml_part') and x not in step_files
+            ]
+
+            record_filename = os.path.join(dir_name, export_filename)
+            log.debug('Record file: %s' % record_filename)
+            self._concatenate_xml_files(
+                record_filename,
+                old_step_files + step_files
+            )
+
+            # the manifest must not end up in the bucket, it is only put
+            # back if the export file was not replaced
+            manifest = os.path.join(dir_name, self.MANIFEST_FILE)
+            manifest_content = None
+            if os.path.exists(manifest):
+                with open(manifest) as manifest_file:
+                    manifest_content = manifest_file.read()
+                os.remove(manifest)
+            # the step files downloaded before are not uploaded again
+            log.debug('Syncing dir %s to S3' % dir_name)
+            try:
+                self._sync_dir_content_to_s3(set_name, dir_name)
+            except Exception:
+                if manifest_content is not None:
+                    with open(manifest, 'w') as manifest_file:
+                        manifest_file.write(manifest_content)
+                raise
+            if composed is not None:
+                composed()
+            if compress:
+                self.storage.upload_compressed_file_to_bucket(
+                    bucket_name,
+                    dir_name,
+                    export_filename,
+                    self.FOOTER
+                )
+            return
+
+        uploads = [upload]
+        if compress:
+            try:
+                compressed_upload = self.storage.open_append_stream(
+                    bucket_name,
+                    export_filename + '.gz',
+                    gzip_member(self.FOOTER)
+                )
+            except Exception:
+                upload.cancel()
+                raise
+            if compressed_upload is not None:
+                uploads.append(compressed_upload)
+        sink = ExportSink(
+            [(x.key_name, x) for x in uploads],
+            dir_name,
+            len(uploads) > 1
+        )
+        try:
+            for step_file in step_files:
+                self._upload_file_to_s3(
+                    set_name,
+                    dir_name,
+                    os.path.basename(step_file)
+                )
+            log.debug(
+                'Appending %d step files to %s on S3'
+                % (len(step_files), export_filename)
+            )
+            for step_file in step_files:
+                with open(step_file) as infile:
+                    for chunk in iter(lambda: infile.read(1048576), ''):
+                        sink.write(chunk)
+            sink.close(self.FOOTER, composed)
+        except Exception:
+            sink.cancel()
+            raise
+
+        if compress and len(uploads) == 1:
+            self._append_to_compressed_file(
+                set_name,
+                dir_name,
+                export_filename,
+                step_files
+            )
+
+    def _append_to_compressed_file(self, set_name, dir_name, export_filename,
+                                   step_files):
+        '''
+        Rebuild a compressed copy that is too small to be composed on S3:
+        its old version without the footer member, the new step files as
+        a new gzip member and the footer
+        '''
+        bucket_name = self.bucket_prefix + '.' + set_name
+        filename = export_filename + '.gz'
+        footer = gzip_member(self.FOOTER)
+        content = self.storage.get_contents_of_file(bucket_name, filename)
+        if content is None or not content.endswith(footer):
+            self._compress_export(set_name, dir_name, export_filename)
+            return
+
+        log.debug('Append %d step files to %s' % (len(step_files), filename))
+        upload = self.storage.open_upload_stream(bucket_name, filename)
+        try:
+            upload.write(content[:-len(footer)])
+            compressed = GzipStream(upload)
+            for step_file in step_files:
+                with open(step_file) as infile:
+                    for chunk in iter(lambda: infile.read(1048576), ''):
+                        compressed.write(chunk)
+            compressed.end_member()
+            upload.write(footer)
+            upload.close()
+        except Exception:
+            upload.cancel()
+            raise
+
+    def _compress_export(self, set_name, dir_name, export_filename):
+        '''
+        Compress the export file on S3 from scratch
+        '''
+        bucket_name = self.bucket_prefix + '.' + set_name
+        log.debug('Compress %s from scratch' % export_filename)
+        compressed_dir = tempfile.mkdtemp(dir=dir_name)
+        self.storage.download_file(
+            bucket_name,
+            export_filename,
+            os.path.join(compressed_dir, export_filename)
+        )
+        self.storage.upload_compressed_file_to_bucket(
+            bucket_name,
+            compressed_dir,
+            export_filename,
+            self.FOOTER
+        )
+
+    def _create_step_file(self, step_name, dir_name, set_name, records):
+        '''
+        Write the serialized records of one step in a single pass
+        '''
+        step_file = os.path.join(
+            dir_name,
+            set_name + '_' + step_name + '.xml_part'
+        )
+        with open(step_file, 'w') as outfile:
+            outfile.write(''.join(records))
+        log.debug('Wrote %d records to %s' % (len(records), step_file))
+        return step_file
 
     def resume_export(self, set_name, append, count, limit):
         params = {
             'resumptionToken': set_name + '|marcxml|' + str(count) + '|||',
         }
-        self.client = ResumptionClient(self.url, 'marcxml', self.registry)
         self.export(set_name, append, params, count, limit)
@@ -1,5 +1,139 @@
-from oaipmh import client, validation
+from oaipmh import client, error, validation
 from oaipmh.datestamp import datetime_to_datestamp
+from transport import HTTPTransport
+from lxml import etree
+from StringIO import StringIO
+from xml.sax.saxutils import unescape
+import itertools
+import Queue
+import re
+import threading
+import time
+import logging
+log = logging.getLogger(__name__)
+
+_END_OF_LIST = object()
+
+NS_OAIPMH = 'http://www.openarchives.org/OAI/2.0/'
+RECORD_TAG = '{%s}record' % NS_OAIPMH
+ERROR_TAG = '{%s}error' % NS_OAIPMH
+OAI_ERRORS = (
+    'badArgument', 'badResumptionToken', 'badVerb',
+    'cannotDisseminateFormat', 'idDoesNotExist', 'noRecordsMatch',
+    'noMetadataFormats', 'noSetHierarchy'
+)
+
+RESUMPTION_TOKEN = re.compile(
+    r'<(?:\w+:)?resumptionToken(?:\s[^>]*)?>([^<]*)'
+    r'</(?:\w+:)?resumptionToken>'
+)
+
+
+class PrefetchListGenerator(object):
+    '''
+    Iterates over a resumption list while a background thread already
+    fetches the following pages into a bounded queue, so the network
+    round trip overlaps with the processing of the current page.
+
+    page_token is the resumption token the current page was requested
+    with (None for the first page) and page_position the number of items
+    already returned from it, which is enough to continue the list later.
+    '''
+    def __init__(self, firstBatch, nextBatch, queue_size=2):
+        self.pages = 0
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+        self.write_time = 0.0
+        self._nextBatch = nextBatch
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._last_yield = None
+        self._closed = False
+
+        start = time.time()
+        result, token = firstBatch()
+        self.fetch_time += time.time() - start
+        self.pages += 1
+        self._items = iter(result)
+        self.page_token = None
+        self.page_position = 0
+
+        self._fetcher = threading.Thread(target=self._fetch, args=(token,))
+        self._fetcher.daemon = True
+        self._fetcher.start()
+
+    def __iter__(self):
+        return self
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fetch(self, token):
+        try:
+            while token is not None:
+                start = time.time()
+                result, next_token = self._nextBatch(token)
+                self.fetch_time += time.time() - start
+                if not self._put((token, result)):
+                    return
+                token = next_token
+        except Exception, e:
+            self._put(e)
+        self._put(_END_OF_LIST)
+
+    def _next_page(self):
+        start = time.time()
+        page = self._queue.get()
+        self.wait_time += time.time() - start
+        if isinstance(page, Exception):
+            self.close()
+            raise page
+        if page is _END_OF_LIST:
+            self.close()
+            raise StopIteration
+        self.pages += 1
+        return page
+
+    def next(self):
+        if self._last_yield is not None:
+            self.write_time += time.time() - self._last_yield
+            self._last_yield = None
+        while True:
+            try:
+                item = self._items.next()
+                break
+            except StopIteration:
+                if self._closed:
+                    raise
+                self.page_token, page = self._next_page()
+                self.page_position = 0
+                self._items = iter(page)
+        self.page_position += 1
+        self._last_yield = time.time()
+        return item
+
+    __next__ = next
+
+    def close(self):
+        '''
+        Stop the background fetcher and log where the time was spent
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._stopped.set()
+        self._items = iter([])
+        log.info(
+            'Read %d pages: fetch %.1fs, waiting for pages %.1fs, '
+            'processing records %.1fs'
+            % (self.pages, self.fetch_time, self.wait_time, self.write_time)
+        )
 
 
 class ResumptionClient(client.Client):
@@ -8,9 +142,30 @@ class ResumptionClient(client.Client):
             base_url,
             metadataPrefix='oai_dc',
             metadata_registry=None,
-            credentials=None):
+            credentials=None,
+            prefetch_pages=2,
+            transport=None):
         client.Client.__init__(self, base_url, metadata_registry, credentials)
         self.metadataPrefix = metadataPrefix
+        self.prefetch_pages = prefetch_pages
+        self.transport = transport or HTTPTransport()
+
+    def makeRequest(self, **kw):
+        headers = {}
+        if self._credentials is not None:
+            headers['Authorization'] = 'Basic ' + self._credentials.strip()
+        response = self.transport.request(
+            'GET',
+            self._base_url,
+            fields=kw,
+            headers=headers
+        )
+        if response.status != 200:
+            raise client.Error(
+                'Request to %s failed with HTTP status %s'
+                % (self._base_url, response.status)
+            )
+        return response.data
 
     def handleVerb(self, verb, kw):
         # validate kw first
@@ -33,26 +188,106 @@ class ResumptionClient(client.Client):
             # until is None but is explicitly in kw, remove it
             del kw['until']
 
+        # ListRecords parses the raw response itself, see ListRecords_impl
+        if verb == 'ListRecords':
+            return self.ListRecords_impl(
+                kw, self.makeRequest(verb=verb, **kw))
+
         # now call underlying implementation
         method_name = verb + '_impl'
         return getattr(self, method_name)(
             kw, self.makeRequestErrorHandling(verb=verb, **kw))
 
-    def ListRecords_impl(self, args, tree):
+    def _resumption_token(self, xml):
+        '''
+        Find the resumption token in the raw response, without parsing it
+        '''
+        # the token is the last element of the list
+        match = (RESUMPTION_TOKEN.search(xml, max(0, len(xml) - 4096)) or
+                 RESUMPTION_TOKEN.search(xml))
+        if match is None or match.group(1).strip() == '':
+            return None
+        return unescape(
+            match.group(1).strip(),
+            {'&quot;': '"', '&apos;': "'"}
+        )
+
+    def _raise_oai_error(self, element):
+        code = element.get('code')
+        msg = element.text
+        if code not in OAI_ERRORS:
+            raise error.UnknownError(
+                "Unknown error code from server: %s, message: %s"
+                % (code, msg)
+            )
+        # find exception in error module and raise with msg
+        raise getattr(error, code[0].upper() + code[1:] + 'Error')(msg)
+
+    def iterRecords(self, metadata_prefix, xml, args):
+        '''
+        Parse a ListRecords response with iterparse and yield its records
+        one by one. A record is cleared as soon as the next one is
+        requested, so the page is never held in memory as a whole tree.
+        '''
         namespaces = self.getNamespaces()
+        context = etree.iterparse(StringIO(xml), events=('end',))
+        try:
+            for event, element in context:
+                if element.tag == ERROR_TAG:
+                    self._raise_oai_error(element)
+                if element.tag != RECORD_TAG:
+                    continue
+
+                header = client.buildHeader(
+                    element.find('{%s}header' % NS_OAIPMH),
+                    namespaces
+                )
+                metadata_node = element.find('{%s}metadata' % NS_OAIPMH)
+                metadata = None
+                if metadata_node is not None:
+                    metadata = self._metadata_registry.readMetadata(
+                        metadata_prefix,
+                        metadata_node
+                    )
+                yield header, metadata, None
+
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        except etree.XMLSyntaxError:
+            raise error.XMLSyntaxError(args)
+
+    def ListRecords_impl(self, args, xml):
         metadata_prefix = args.get('metadataPrefix', self.metadataPrefix)
-        metadata_registry = self._metadata_registry
 
         def firstBatch():
-            return self.buildRecords(
-                metadata_prefix, namespaces,
-                metadata_registry, tree)
+            records = self.iterRecords(metadata_prefix, xml, args)
+            # parse up to the first record to find errors in the response
+            try:
+                first = records.next()
+            except StopIteration:
+                return [], self._resumption_token(xml)
+            return (
+                itertools.chain([first], records),
+                self._resumption_token(xml)
+            )
 
         def nextBatch(token):
-            tree = self.makeRequestErrorHandling(
-                verb='ListRecords',
-                resumptionToken=token)
-            return self.buildRecords(
-                metadata_prefix, namespaces,
-                metadata_registry, tree)
-        return client.ResumptionListGenerator(firstBatch, nextBatch)
+            args = {'verb': 'ListRecords', 'resumptionToken': token}
+            xml = self.makeRequest(**args)
+            return (
+                self.iterRecords(metadata_prefix, xml, args),
+                self._resumption_token(xml)
+            )
+        # errors of the first request are raised right away
+        first_batch = firstBatch()
+        if self.prefetch_pages:
+            return PrefetchListGenerator(
+                lambda: first_batch,
+                nextBatch,
+                self.prefetch_pages
+            )
+        return client.ResumptionListGenerator(
+            lambda: first_batch,
+            nextBatch
+        )
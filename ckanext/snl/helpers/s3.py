@@ -1,54 +1,653 @@
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from filechunkio import FileChunkIO
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pylons import config
+from storage import Storage, ConfigEntryNotFoundError
+import workdir
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+import Queue
+import json
+import threading
+import hashlib
+import time
 import math
 import os
 import logging
 log = logging.getLogger(__name__)
 
+# Size of the ranges copied on the server side, S3 allows up to 5GB
+COPY_PART_SIZE = 1073741824  # 1GB
+
+# Objects larger than this are downloaded as parallel ranged GETs
+DOWNLOAD_PART_SIZE = 16777216  # 16MB
+
+# S3 limit of parts per multipart upload
+MAX_PARTS = 10000
+
+
+# connection and bucket of a pool thread, kept for its whole lifetime
+_worker = threading.local()
+
+# upload pools shared by all S3 instances of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _init_worker(aws_key, aws_secret, bucket_name):
+    conn = S3Connection(aws_key, aws_secret)
+    _worker.bucket = conn.get_bucket(bucket_name, validate=False)
+
 
 # inspired by
 # www.topfstedt.de/python-parallel-s3-multipart-upload-with-retries.html
-def _upload_part(aws_key, aws_secret, bucket_name, multipart_id,
-                 part_num, source_path, offset, bytes,
-                 amount_of_retries=10):
+def _upload_part(key_name, multipart_id, part_num, source_path, offset,
+                 bytes, amount_of_retries=10):
+    """
+    Uploads a part with retries in a pool thread (see _init_worker).
+
+    Returns the ETag of the part, the name of the thread and the time
+    the upload took.
+    """
+    log.info('Start uploading part #%d of %s' % (part_num, source_path))
+    start = time.time()
+    with FileChunkIO(source_path, 'r', offset=offset, bytes=bytes) as fp:
+        etag = _send_part(
+            _worker.bucket,
+            key_name,
+            multipart_id,
+            part_num,
+            fp,
+            amount_of_retries
+        )
+    log.info('Uploaded part #%d' % part_num)
+    return etag, threading.current_thread().name, time.time() - start
+
+
+def _try_upload_part(key_name, multipart_id, part_num, source_path, offset,
+                     bytes):
+    """
+    Like _upload_part, but returns the error instead of raising it, the
+    pool of Python 2 has no error callback.
+    """
+    try:
+        return part_num, None, _upload_part(
+            key_name,
+            multipart_id,
+            part_num,
+            source_path,
+            offset,
+            bytes
+        )
+    except Exception, e:
+        return part_num, str(e), None
+
+
+def _send(bucket, key_name, fp, headers=None, query_args=None,
+          amount_of_retries=10):
     """
-    Uploads a part with retries.
+    Uploads the content of fp to a key (or a part of a multipart upload)
+    with retries and returns its ETag.
     """
-    def _upload(retries_left=amount_of_retries):
+    retries_left = amount_of_retries
+    while True:
         try:
-            log.info(
-                'Start uploading part #%d of %s' % (part_num, source_path)
-            )
-            conn = S3Connection(aws_key, aws_secret)
-            bucket = conn.get_bucket(bucket_name)
-            for mp in bucket.get_all_multipart_uploads():
-                if mp.id == multipart_id:
-                    with FileChunkIO(source_path, 'r', offset=offset,
-                                     bytes=bytes) as fp:
-                        mp.upload_part_from_file(fp=fp, part_num=part_num)
-                    break
+            fp.seek(0)
+            key = bucket.new_key(key_name)
+            key.set_contents_from_file(
+                fp,
+                headers=headers,
+                query_args=query_args
+            )
+            return key.etag
+        except Exception, e:
+            if not retries_left:
+                log.debug('Failed uploading %s' % key_name)
+                log.exception(e)
+                raise e
+            retries_left -= 1
+
+
+def _send_part(bucket, key_name, multipart_id, part_num, fp,
+               amount_of_retries=10):
+    """
+    Uploads a part of a known multipart upload with retries and returns
+    its ETag.
+    """
+    query_args = 'uploadId=%s&partNumber=%d' % (multipart_id, part_num)
+    return _send(
+        bucket,
+        key_name,
+        fp,
+        query_args=query_args,
+        amount_of_retries=amount_of_retries
+    )
+
+
+def _put_file(key_name, source_path, headers, amount_of_retries=10):
+    """
+    Uploads a small file with a single PUT in a pool thread.
+
+    Returns the ETag of the file, the name of the thread and the time
+    the upload took.
+    """
+    start = time.time()
+    with open(source_path, 'rb') as fp:
+        etag = _send(
+            _worker.bucket,
+            key_name,
+            fp,
+            headers=headers,
+            amount_of_retries=amount_of_retries
+        )
+    log.info('Uploaded %s' % source_path)
+    return etag, threading.current_thread().name, time.time() - start
+
+
+def _download(bucket, key_name, dump_file, start=0, end=None,
+              amount_of_retries=10):
+    """
+    Downloads a key (or the bytes start to end of it) with retries and
+    writes it at the same position of the existing dump_file.
+    """
+    headers = None
+    if end is not None:
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    retries_left = amount_of_retries
+    while True:
+        try:
+            key = bucket.new_key(key_name)
+            with open(dump_file, 'r+b') as fp:
+                fp.seek(start)
+                key.get_contents_to_file(fp, headers=headers)
+            return
         except Exception, e:
-            if retries_left:
-                _upload(retries_left=retries_left - 1)
-            else:
-                log.debug('Failed uploading part #%d' % part_num)
+            if not retries_left:
+                log.debug('Failed downloading %s' % key_name)
                 log.exception(e)
                 raise e
+            retries_left -= 1
+
+
+def _chunk_size(source_size):
+    """
+    Size of the parts of a multipart upload of a file
+    """
+    default_chunk_size = 5242880  # ~5MB
+    return max(
+        int(math.sqrt(default_chunk_size) * math.sqrt(source_size)),
+        default_chunk_size
+    )
+
+
+def _md5(fp, bytes=None):
+    """
+    MD5 of the next bytes of fp (or of the rest of it)
+    """
+    md5 = hashlib.md5()
+    while bytes is None or bytes > 0:
+        size = 1048576 if bytes is None else min(1048576, bytes)
+        data = fp.read(size)
+        if not data:
+            break
+        md5.update(data)
+        if bytes is not None:
+            bytes -= len(data)
+    return md5
+
+
+def _file_etag(source_path, part_size=None):
+    """
+    ETag S3 reports for a file uploaded with a single PUT, or as a
+    multipart upload with parts of part_size
+    """
+    with open(source_path, 'rb') as fp:
+        if part_size is None:
+            return _md5(fp).hexdigest()
+        digests = []
+        while True:
+            start = fp.tell()
+            digest = _md5(fp, part_size)
+            if fp.tell() == start:
+                break
+            digests.append(digest.digest())
+    return '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+def _log_throughput(workers, name):
+    """
+    Logs the throughput of the pool threads from
+    {thread name: (bytes, seconds)}
+    """
+    for worker, (sent, total_time) in sorted(workers.items()):
+        log.info(
+            'Worker %s uploaded %.1f MB of %s at %.2f MB/s'
+            % (
+                worker,
+                sent / 1048576.0,
+                name,
+                sent / 1048576.0 / max(total_time, 0.001)
+            )
+        )
+
+
+def _complete_upload(bucket, key_name, multipart_id, etags):
+    """
+    Completes a multipart upload from the ETags of its parts, without
+    listing them
+    """
+    parts = ''.join(
+        '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>'
+        % (part_num, escape(etag))
+        for part_num, etag in enumerate(etags, 1)
+    )
+    bucket.complete_multipart_upload(
+        key_name,
+        multipart_id,
+        '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % parts
+    )
+
+
+class MultipartStreamUpload(object):
+    '''
+    File-like object that uploads the data written to it as parts of a
+    multipart upload, as soon as part_size bytes have been buffered.
+
+    The parts are sent by background threads with their own connection,
+    so the upload overlaps with producing the data. Passing the upload_id
+    and etags of an earlier stream continues that upload.
+    '''
+    MIN_PART_SIZE = 5242880  # ~5MB
+
+    def __init__(self, s3, key_name, headers=None, upload_id=None,
+                 etags=None, pending=None, part_size=16777216,
+                 parallel_uploads=2):
+        self.s3 = s3
+        self.key_name = key_name
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        if upload_id is None:
+            upload_id = s3.bucket.initiate_multipart_upload(
+                key_name,
+                headers=headers
+            ).id
+        self.upload_id = upload_id
+        self.etags = dict(enumerate(etags or [], 1))
+        self.part_count = len(self.etags)
+        self._buffer = []
+        self._buffered = 0
+        if pending:
+            self._buffer.append(pending)
+            self._buffered = len(pending)
+        self._errors = []
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(maxsize=parallel_uploads)
+        self._workers = []
+        for i in range(parallel_uploads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        conn = S3Connection(self.s3.key, self.s3.token)
+        bucket = conn.get_bucket(self.s3.bucket_name, validate=False)
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                part_num, data = item
+                log.info(
+                    'Start uploading part #%d of %s'
+                    % (part_num, self.key_name)
+                )
+                etag = _send_part(
+                    bucket,
+                    self.key_name,
+                    self.upload_id,
+                    part_num,
+                    StringIO(data)
+                )
+                with self._lock:
+                    self.etags[part_num] = etag
+                log.info('Uploaded part #%d' % part_num)
+            except Exception, e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _check_errors(self):
+        if self._errors:
+            raise UploadIncompleteError(
+                "Uploading a part of %s failed: %s"
+                % (self.key_name, self._errors[0])
+            )
+
+    def _flush(self):
+        self.part_count += 1
+        self._queue.put((self.part_count, ''.join(self._buffer)))
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        '''
+        Buffer data and return True if it completed a part
+        '''
+        self._check_errors()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.part_size:
+            self._flush()
+            return True
+        return False
+
+    def get_pending(self):
+        '''
+        Return the buffered data that is not part of a part yet
+        '''
+        return ''.join(self._buffer)
+
+    def is_uploaded(self, part_count):
+        with self._lock:
+            return all(
+                i in self.etags for i in range(1, part_count + 1)
+            )
+
+    def get_etags(self, part_count):
+        with self._lock:
+            return [self.etags[i] for i in range(1, part_count + 1)]
+
+    def _stop_workers(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        self._workers = []
+
+    def close(self):
+        '''
+        Upload the remaining data and complete the upload
+        '''
+        if self._buffered or not self.part_count:
+            self._flush()
+        self._queue.join()
+        self._stop_workers()
+        self._check_errors()
+
+        # only the parts of this stream, later parts of an earlier run
+        # of a resumed stream are dropped
+        _complete_upload(
+            self.s3.bucket,
+            self.key_name,
+            self.upload_id,
+            self.get_etags(self.part_count)
+        )
+        _key_cache.invalidate(self.key_name)
+        log.info('Upload of %s completed' % self.key_name)
+
+    def cancel(self, abort=True):
+        '''
+        Stop uploading, abort the multipart upload unless it should be
+        continued later
+        '''
+        self._stop_workers()
+        if abort:
+            log.error('Upload of %s failed, cancel' % self.key_name)
+            self.s3.bucket.cancel_multipart_upload(
+                self.key_name,
+                self.upload_id
+            )
+
+
+class UploadJournal(object):
+    '''
+    Local record of the multipart upload of a file: its upload id and the
+    ETags of the uploaded parts. A restarted upload of the same file
+    continues the upload and only sends the missing parts.
+    '''
+    def __init__(self, key_name, source_path):
+        self.path = os.path.join(
+            workdir.get_work_dir('uploads'),
+            hashlib.md5(key_name).hexdigest() + '.json'
+        )
+        stat = os.stat(source_path)
+        self.source = {
+            'key_name': key_name,
+            'source_path': os.path.abspath(source_path),
+            'source_size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+        }
+        self.upload_id = None
+        # part number -> offset, bytes and etag (None until uploaded)
+        self.parts = {}
+        # upload of an older version of the file
+        self.stale_upload_id = None
+        try:
+            with open(self.path) as journal_file:
+                state = json.load(journal_file)
+        except (IOError, ValueError):
+            return
+        if state['source'] == self.source and 'parts' in state:
+            self.upload_id = state['upload_id']
+            self.parts = dict(
+                (int(part_num), part)
+                for part_num, part in state['parts'].items()
+            )
         else:
-            log.info('Uploaded part #%d' % part_num)
+            self.stale_upload_id = state['upload_id']
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as journal_file:
+            json.dump({
+                'source': self.source,
+                'upload_id': self.upload_id,
+                'parts': self.parts,
+            }, journal_file)
+        os.rename(self.path + '.tmp', self.path)
+
+    def start(self, upload_id):
+        self.upload_id = upload_id
+        self.parts = {}
+        self._save()
+
+    def plan_part(self, part_num, offset, bytes):
+        self.parts[part_num] = {'offset': offset, 'bytes': bytes, 'etag': None}
+        self._save()
+
+    def add_part(self, part_num, etag):
+        self.parts[part_num]['etag'] = etag
+        self._save()
+
+    def get_uploaded(self):
+        return [x for x in self.parts.values() if x['etag'] is not None]
+
+    def get_missing(self):
+        '''
+        Return the planned parts that are not uploaded yet
+        '''
+        return [
+            (part_num, part['offset'], part['bytes'])
+            for part_num, part in sorted(self.parts.items())
+            if part['etag'] is None
+        ]
+
+    def get_planned_size(self):
+        return sum(part['bytes'] for part in self.parts.values())
 
-    _upload()
+    def get_etags(self):
+        return [part['etag'] for part_num, part in sorted(self.parts.items())]
 
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
-class S3():
+
+class UploadTuner(object):
+    '''
+    Picks the number of parts in flight and the size of the next part of
+    a multipart upload from the measured throughput.
+
+    After every window of parts the concurrency moves one step towards
+    the level with the best total throughput measured so far, trying the
+    next higher level while it is unknown. If the throughput drops at
+    the same level, the link changed: the concurrency is halved and the
+    levels are measured again. The part size is set so that a part takes
+    about target_part_time seconds at the measured throughput of a single
+    connection.
+    '''
+    def __init__(self, min_concurrency, max_concurrency, min_part_size,
+                 max_part_size, part_size, target_part_time=10.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(min_concurrency, max_concurrency)
+        self.min_part_size = min_part_size
+        self.max_part_size = max(min_part_size, max_part_size)
+        self.target_part_time = target_part_time
+        self.concurrency = self.min_concurrency
+        self.part_size = self._clamp_part_size(part_size)
+        # (seconds since start, concurrency, part size, bytes/s, latency)
+        self.curve = []
+        self._start = time.time()
+        self._window_start = self._start
+        self._window = []
+        self._last_throughput = None
+        self._last_concurrency = None
+        # concurrency -> last total throughput measured at that level
+        self._levels = {}
+
+    def _clamp_part_size(self, part_size):
+        return min(max(part_size, self.min_part_size), self.max_part_size)
+
+    def add_part(self, bytes, elapsed):
+        self._window.append((bytes, elapsed))
+        if len(self._window) < self.concurrency:
+            return
+        now = time.time()
+        sent = sum(x[0] for x in self._window)
+        busy = sum(x[1] for x in self._window)
+        throughput = sent / max(now - self._window_start, 0.001)
+        latency = busy / len(self._window)
+        self.curve.append((
+            now - self._start,
+            self.concurrency,
+            self.part_size,
+            throughput,
+            latency
+        ))
+
+        level = self.concurrency
+        self._levels[level] = throughput
+        lower = self._levels.get(level - 1)
+        higher = self._levels.get(level + 1)
+        if (self._last_concurrency == level and
+                throughput < self._last_throughput * 0.8):
+            self._levels = {}
+            level = level // 2
+        elif lower is not None and lower > throughput * 1.05:
+            level -= 1
+        elif higher is None or higher > throughput * 1.05:
+            level += 1
+        self._last_concurrency = self.concurrency
+        self._last_throughput = throughput
+        self.concurrency = min(
+            max(level, self.min_concurrency),
+            self.max_concurrency
+        )
+        self.part_size = self._clamp_part_size(
+            int(sent / max(busy, 0.001) * self.target_part_time)
+        )
+        self._window = []
+        self._window_start = now
+
+    def log_curve(self, name):
+        for seconds, concurrency, part_size, throughput, latency in self.curve:
+            log.info(
+                'Upload of %s after %.1fs: %d parts in flight of %.1f MB, '
+                '%.2f MB/s, %.1fs per part'
+                % (
+                    name,
+                    seconds,
+                    concurrency,
+                    part_size / 1048576.0,
+                    throughput / 1048576.0,
+                    latency
+                )
+            )
+
+
+class KeyMetadataCache(object):
+    '''
+    Size, ETag and last-modified date of the keys below a bucket prefix,
+    filled by one listing per prefix and kept for ttl seconds.
+
+    Uploads invalidate the prefix of the uploaded key.
+    '''
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._prefixes = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket, bucket_name, filename):
+        '''
+        Return the metadata of a key or None if it does not exist
+        '''
+        with self._lock:
+            loaded_at, keys = self._prefixes.get(bucket_name, (None, None))
+        if loaded_at is None or time.time() - loaded_at > self.ttl:
+            prefix = bucket_name + '/'
+            keys = {}
+            for key in bucket.list(prefix=prefix):
+                keys[key.name[len(prefix):].encode('utf-8')] = {
+                    'size': key.size,
+                    'etag': key.etag,
+                    'last_modified': key.last_modified,
+                }
+            log.debug('Cached metadata of %d keys of %s' % (len(keys), prefix))
+            with self._lock:
+                self._prefixes[bucket_name] = (time.time(), keys)
+        return keys.get(filename)
+
+    def invalidate(self, key_name):
+        with self._lock:
+            self._prefixes.pop(key_name.rsplit('/', 1)[0], None)
+
+
+# key metadata shared by all S3 instances of the process
+_key_cache = KeyMetadataCache()
+
+
+class S3(Storage):
     def __init__(self):
         try:
             self.key = config['ckanext.snl.s3_key']
             self.token = config['ckanext.snl.s3_token']
             self.bucket_name = config['ckanext.snl.s3_bucket']
+            self.upload_concurrency = int(
+                config.get('ckanext.snl.s3_upload_concurrency', 4)
+            )
+            self.download_concurrency = int(
+                config.get('ckanext.snl.s3_download_concurrency', 4)
+            )
+            self.single_put_size = int(
+                config.get('ckanext.snl.s3_single_put_size', 16777216)
+            )
+            self.part_retries = int(
+                config.get('ckanext.snl.s3_part_retries', 2)
+            )
+            self.min_upload_concurrency = int(
+                config.get('ckanext.snl.s3_min_upload_concurrency', 1)
+            )
+            self.min_part_size = max(
+                int(config.get('ckanext.snl.s3_min_part_size', 5242880)),
+                5242880
+            )
+            self.max_part_size = int(
+                config.get('ckanext.snl.s3_max_part_size', 268435456)
+            )
+            self.upload_timeout = int(
+                config.get('ckanext.snl.s3_upload_timeout', 3600)
+            )
+            _key_cache.ttl = int(
+                config.get('ckanext.snl.s3_key_cache_ttl', 300)
+            )
             conn = S3Connection(self.key, self.token)
             self.bucket = conn.get_bucket(self.bucket_name)
         except KeyError as e:
@@ -63,6 +662,25 @@ class S3():
             % (self.key, self.token, self.bucket_name)
         )
 
+    def _get_pool(self):
+        '''
+        Return the long-lived upload pool of this bucket, its threads keep
+        their connection for all uploads of the process.
+
+        Threads instead of processes: a process forked while export,
+        prefetch and upload threads hold locks (e.g. of logging) can
+        deadlock, and a dead worker process never reports its task.
+        '''
+        with _pools_lock:
+            pool_key = (self.key, self.bucket_name)
+            if pool_key not in _pools:
+                _pools[pool_key] = ThreadPool(
+                    processes=self.upload_concurrency,
+                    initializer=_init_worker,
+                    initargs=(self.key, self.token, self.bucket_name)
+                )
+            return _pools[pool_key]
+
     def list(self, prefix=None):
         for key in self.bucket.list(prefix=prefix):
             yield key
@@ -72,89 +690,455 @@ class S3():
             yield key.name.encode('utf-8')
 
     def download_bucket_to_dir(self, prefix, dir_name, ignore=None):
+        '''
+        Download the keys of a prefix to a directory with parallel
+        workers, large keys as ranged GETs, and return the files
+        '''
         files = []
+        tasks = Queue.Queue()
         for key in self.list(prefix):
             filename = key.name.replace(prefix, '').encode('utf-8')
             if (ignore is not None and filename not in ignore):
                 dump_file = os.path.join(dir_name, filename)
                 log.debug('Dump file %s to %s' % (key.key, dump_file))
-                key.get_contents_to_filename(dump_file)
+                # the workers write their ranges into the existing file
+                with open(dump_file, 'wb') as fp:
+                    fp.truncate(key.size)
+                if key.size <= DOWNLOAD_PART_SIZE:
+                    tasks.put((key.name, dump_file, 0, None))
+                else:
+                    for start in range(0, key.size, DOWNLOAD_PART_SIZE):
+                        end = min(start + DOWNLOAD_PART_SIZE, key.size) - 1
+                        tasks.put((key.name, dump_file, start, end))
                 files.append(dump_file)
+
+        errors = []
+
+        def work():
+            conn = S3Connection(self.key, self.token)
+            bucket = conn.get_bucket(self.bucket_name, validate=False)
+            while True:
+                try:
+                    task = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    _download(bucket, *task)
+                except Exception, e:
+                    errors.append(e)
+
+        start = time.time()
+        workers = []
+        for i in range(min(self.download_concurrency, tasks.qsize())):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        log.info(
+            'Downloaded %d files of %s with %d workers in %.1fs'
+            % (len(files), prefix, len(workers), time.time() - start)
+        )
         return files
 
+    def get_key_metadata(self, bucket_name, filename):
+        '''
+        Return size, etag and last_modified of a file (or None if it does
+        not exist) from the key metadata cache
+        '''
+        return _key_cache.get(self.bucket, bucket_name, filename)
+
     def get_url_of_file(self, bucket_name, filename):
-        bucket_path = bucket_name + '/' + filename
-        key = self.bucket.get_key(bucket_path)
+        if self.get_key_metadata(bucket_name, filename) is None:
+            return None
+        key = Key(self.bucket, bucket_name + '/' + filename)
         return key.generate_url(0, query_auth=False, force_http=True)
 
-    def get_size_of_file(self, bucket_name, filename):
+    def get_contents_of_file(self, bucket_name, filename):
         bucket_path = bucket_name + '/' + filename
         key = self.bucket.get_key(bucket_path)
-        return self.bucket.lookup(key).size
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def download_file(self, bucket_name, filename, path):
+        key = self.bucket.get_key(bucket_name + '/' + filename)
+        with open(path, 'wb') as fp:
+            key.get_contents_to_file(fp)
+
+    def upload_string_to_bucket(self, bucket_name, filename, content):
+        key = Key(self.bucket)
+        key.key = bucket_name + '/' + filename
+        key.set_contents_from_string(content)
+        _key_cache.invalidate(key.key)
 
-    def upload_dir_to_bucket(self, bucket_name, dir_name):
-        for filename in os.listdir(dir_name):
+    def open_upload_stream(self, bucket_name, filename, upload_id=None,
+                           etags=None, pending=None):
+        headers = {
+            'Content-Type': 'binary/octet-stream',
+            'Content-Disposition': 'attachment; filename="%s"' %
+            filename
+        }
+        return MultipartStreamUpload(
+            self,
+            bucket_name + '/' + filename,
+            headers,
+            upload_id,
+            etags,
+            pending
+        )
+
+    def open_append_stream(self, bucket_name, filename, footer):
+        '''
+        Start a new version of a file that begins with the existing file
+        without its footer, copied on the server side with upload-part-copy.
+
+        Returns the stream to write the appended data to, or None if the
+        file does not exist or is too small to be copied as a part.
+        '''
+        key_name = bucket_name + '/' + filename
+        key = self.bucket.get_key(key_name)
+        if key is None:
+            return None
+        copy_size = key.size - len(footer)
+        if copy_size < MultipartStreamUpload.MIN_PART_SIZE:
+            return None
+        tail = key.get_contents_as_string(
+            headers={'Range': 'bytes=%d-' % copy_size}
+        )
+        if tail != footer:
+            log.debug('%s does not end with the expected footer' % key_name)
+            return None
+
+        headers = {
+            'Content-Type': 'binary/octet-stream',
+            'Content-Disposition': 'attachment; filename="%s"' %
+            filename
+        }
+        mp = self.bucket.initiate_multipart_upload(key_name, headers=headers)
+        try:
+            etags = []
+            # the last range takes the remainder, every part but the last
+            # one of the upload has to be at least 5MB
+            part_count = max(1, copy_size // COPY_PART_SIZE)
+            for i in range(part_count):
+                start = i * COPY_PART_SIZE
+                end = start + COPY_PART_SIZE - 1
+                if i == part_count - 1:
+                    end = copy_size - 1
+                log.debug(
+                    'Copy bytes %d-%d of %s as part #%d'
+                    % (start, end, key_name, i + 1)
+                )
+                part = mp.copy_part_from_key(
+                    self.bucket_name,
+                    key_name,
+                    i + 1,
+                    start,
+                    end
+                )
+                etags.append(part.etag)
+        except Exception:
+            mp.cancel_upload()
+            raise
+        return MultipartStreamUpload(
+            self,
+            key_name,
+            upload_id=mp.id,
+            etags=etags
+        )
+
+    def has_multipart_upload(self, bucket_name, filename, upload_id):
+        key_name = bucket_name + '/' + filename
+        for mp in self.bucket.get_all_multipart_uploads(prefix=key_name):
+            if mp.id == upload_id:
+                return True
+        return False
+
+    def _is_unchanged(self, source_path, source_size, key):
+        if key.size != source_size:
+            return False
+        etag = key.etag.strip('"')
+        if '-' not in etag:
+            return _file_etag(source_path) == etag
+        # multipart uploads of upload_file_to_bucket carry the MD5 of
+        # the file, older ones used parts of _chunk_size
+        md5 = self.bucket.get_key(key.name).get_metadata('md5')
+        if md5 is not None:
+            return _file_etag(source_path) == md5
+        part_size = _chunk_size(source_size)
+        part_count = int(math.ceil(source_size / float(part_size)))
+        if etag.split('-')[1] != str(part_count):
+            return False
+        return _file_etag(source_path, part_size) == etag
+
+    def sync_dir_to_bucket(self, bucket_name, dir_name):
+        '''
+        Upload the files of a directory that are new or differ from the
+        objects in the bucket (compared by size and MD5 or multipart ETag)
+        and return their names
+        '''
+        prefix = bucket_name + '/'
+        keys = {}
+        for key in self.list(prefix):
+            keys[key.name[len(prefix):].encode('utf-8')] = key
+
+        changed = []
+        unchanged_size = 0
+        filenames = sorted(os.listdir(dir_name))
+        for filename in filenames:
+            source_path = os.path.join(dir_name, filename)
+            source_size = os.stat(source_path).st_size
+            if (filename in keys and
+                    self._is_unchanged(source_path, source_size,
+                                       keys[filename])):
+                unchanged_size += source_size
+                continue
+            changed.append(filename)
+
+        log.info(
+            'Sync of %s: %d of %d files unchanged (%.1f MB not uploaded)'
+            % (
+                dir_name,
+                len(filenames) - len(changed),
+                len(filenames),
+                unchanged_size / 1048576.0
+            )
+        )
+        if changed:
+            self.upload_dir_to_bucket(bucket_name, dir_name, changed)
+        return changed
+
+    def upload_dir_to_bucket(self, bucket_name, dir_name, filenames=None):
+        '''
+        Upload all files of a directory (or the given ones) concurrently,
+        small files with a single PUT each
+        '''
+        if filenames is None:
+            filenames = sorted(os.listdir(dir_name))
+        pool = self._get_pool()
+        results = []
+        large_files = []
+        for filename in filenames:
+            source_path = os.path.join(dir_name, filename)
+            source_size = os.stat(source_path).st_size
+            if source_size > self.single_put_size:
+                large_files.append(filename)
+                continue
+            headers = {
+                'Content-Type': 'binary/octet-stream',
+                'Content-Disposition': 'attachment; filename="%s"' %
+                filename
+            }
+            results.append((filename, source_size, pool.apply_async(
+                _put_file,
+                [bucket_name + '/' + filename, source_path, headers]
+            )))
+
+        # the parts of large files share the pool with the small files
+        for filename in large_files:
             self.upload_file_to_bucket(bucket_name, dir_name, filename)
 
+        failed = []
+        workers = {}
+        for filename, source_size, result in results:
+            try:
+                etag, worker, elapsed = result.get(self.upload_timeout)
+            except Exception, e:
+                log.error('Uploading %s failed: %s' % (filename, e))
+                failed.append(filename)
+                continue
+            sent, total_time = workers.get(worker, (0, 0.0))
+            workers[worker] = (sent + source_size, total_time + elapsed)
+        _log_throughput(workers, dir_name)
+        _key_cache.invalidate(bucket_name + '/')
+
+        if failed:
+            raise UploadIncompleteError(
+                "Only %d of %d files could be uploaded from %s"
+                % (len(results) - len(failed), len(results), dir_name)
+            )
+
     def upload_file_to_bucket(self, bucket_name, dir_name, filename,
-                              parallel_processes=4):
+                              compress=False, footer=None):
         key = Key(self.bucket)
         key.key = bucket_name + '/' + filename
 
-        default_chunk_size = 5242880  # ~5MB
         source_path = os.path.join(dir_name, filename)
         source_size = os.stat(source_path).st_size
-        bytes_per_chunk = max(
-            int(math.sqrt(default_chunk_size) * math.sqrt(source_size)),
-            default_chunk_size
-        )
-        chunk_amount = int(math.ceil(source_size / float(bytes_per_chunk)))
         headers = {
             'Content-Type': 'binary/octet-stream',
             'Content-Disposition': 'attachment; filename="%s"' %
             filename
         }
 
-        mp = self.bucket.initiate_multipart_upload(key.key, headers=headers)
-        pool = Pool(processes=parallel_processes)
-        log.debug('Start upload of %s' % source_path)
-        for i in range(chunk_amount):
-            offset = i * bytes_per_chunk
-            remaining_bytes = source_size - offset
-            bytes = min([bytes_per_chunk, remaining_bytes])
-            part_num = i + 1
-            pool.apply_async(
-                _upload_part,
-                [
-                    self.key,
-                    self.token,
-                    self.bucket_name,
-                    mp.id,
-                    part_num,
-                    source_path,
-                    offset,
-                    bytes
-                ]
+        if source_size <= self.single_put_size:
+            log.debug('Start single upload of %s' % source_path)
+            with open(source_path, 'rb') as fp:
+                _send(self.bucket, key.key, fp, headers=headers)
+            log.info('Upload of %s completed' % source_path)
+        else:
+            self._upload_parts(key.key, source_path, source_size, headers)
+        _key_cache.invalidate(key.key)
+
+        if compress:
+            self.upload_compressed_file_to_bucket(
+                bucket_name,
+                dir_name,
+                filename,
+                footer
             )
-        pool.close()
-        pool.join()
 
-        uploaded_chunk_amount = len(mp.get_all_parts())
+    def _upload_parts(self, key_name, source_path, source_size, headers):
+        '''
+        Upload a file as multipart upload, with concurrency and part sizes
+        picked by an UploadTuner, and record the parts in an
+        UploadJournal. Failed parts are retried on their own, if some
+        still fail the upload is kept for the next attempt.
+        '''
+        filename = os.path.basename(source_path)
 
-        if uploaded_chunk_amount == chunk_amount:
-            mp.complete_upload()
-            log.info('Upload of %s completed' % source_path)
+        journal = UploadJournal(key_name, source_path)
+        if journal.stale_upload_id is not None:
+            log.debug('Abort upload of an older version of %s' % filename)
+            try:
+                self.bucket.cancel_multipart_upload(
+                    key_name,
+                    journal.stale_upload_id
+                )
+            except Exception, e:
+                log.debug(e)
+        bucket_name, key_filename = key_name.rsplit('/', 1)
+        if (journal.upload_id is not None and
+                self.has_multipart_upload(
+                    bucket_name,
+                    key_filename,
+                    journal.upload_id)):
+            log.info(
+                'Resume upload of %s, %d parts already uploaded'
+                % (source_path, len(journal.get_uploaded()))
+            )
         else:
-            log.error('Upload of %s failed, cancel' % source_path)
-            mp.cancel_upload()
+            # the MD5 allows to compare the file later (see _is_unchanged)
+            headers = dict(headers)
+            headers['x-amz-meta-md5'] = _file_etag(source_path)
+            journal.start(
+                self.bucket.initiate_multipart_upload(
+                    key_name,
+                    headers=headers
+                ).id
+            )
+            log.debug('Start upload of %s' % source_path)
+
+        tuner = UploadTuner(
+            self.min_upload_concurrency,
+            self.upload_concurrency,
+            self.min_part_size,
+            self.max_part_size,
+            _chunk_size(source_size)
+        )
+        pool = self._get_pool()
+        done = Queue.Queue()
+        retry = journal.get_missing()
+        next_offset = journal.get_planned_size()
+        next_part_num = len(journal.parts) + 1
+        in_flight = {}
+        attempts = {}
+        failed = []
+        workers = {}
+        while True:
+            while len(in_flight) < tuner.concurrency:
+                if retry:
+                    part_num, offset, bytes = retry.pop(0)
+                elif next_offset < source_size:
+                    remaining = source_size - next_offset
+                    bytes = max(
+                        tuner.part_size,
+                        remaining // max(MAX_PARTS - next_part_num, 1) + 1
+                    )
+                    # no part but the last one may be smaller than 5MB
+                    if remaining - bytes < self.min_part_size:
+                        bytes = remaining
+                    part_num, offset = next_part_num, next_offset
+                    journal.plan_part(part_num, offset, bytes)
+                    next_part_num += 1
+                    next_offset += bytes
+                else:
+                    break
+                in_flight[part_num] = (offset, bytes)
+                pool.apply_async(
+                    _try_upload_part,
+                    [
+                        key_name,
+                        journal.upload_id,
+                        part_num,
+                        source_path,
+                        offset,
+                        bytes
+                    ],
+                    callback=done.put
+                )
+            if not in_flight:
+                break
+
+            try:
+                part_num, error, result = done.get(
+                    timeout=self.upload_timeout
+                )
+            except Queue.Empty:
+                # the journal keeps the uploaded parts for the next attempt
+                log.error(
+                    'No part of %s finished within %ds, giving up on parts %s'
+                    % (filename, self.upload_timeout, sorted(in_flight))
+                )
+                failed.extend(in_flight)
+                break
+            offset, bytes = in_flight.pop(part_num)
+            if error is not None:
+                log.error(
+                    'Uploading part #%d of %s failed: %s'
+                    % (part_num, filename, error)
+                )
+                attempts[part_num] = attempts.get(part_num, 0) + 1
+                if attempts[part_num] <= self.part_retries:
+                    log.warning('Retry part #%d of %s' % (part_num, filename))
+                    retry.append((part_num, offset, bytes))
+                else:
+                    failed.append(part_num)
+                continue
+            etag, worker, elapsed = result
+            journal.add_part(part_num, etag)
+            tuner.add_part(bytes, elapsed)
+            sent, total_time = workers.get(worker, (0, 0.0))
+            workers[worker] = (sent + bytes, total_time + elapsed)
+        _log_throughput(workers, filename)
+        tuner.log_curve(filename)
+
+        if failed:
+            log.error(
+                'Upload of %s failed, the next upload continues it'
+                % source_path
+            )
             raise UploadIncompleteError(
                 "Only %d of %d chunks could be uploaded for file %s"
-                % (uploaded_chunk_amount, chunk_amount, filename)
+                % (
+                    len(journal.parts) - len(failed),
+                    len(journal.parts),
+                    filename
+                )
             )
 
-
-class ConfigEntryNotFoundError(Exception):
-    pass
+        _complete_upload(
+            self.bucket,
+            key_name,
+            journal.upload_id,
+            journal.get_etags()
+        )
+        journal.remove()
+        log.info('Upload of %s completed' % source_path)
 
 
 class UploadIncompleteError(Exception):
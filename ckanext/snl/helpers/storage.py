@@ -0,0 +1,411 @@
+from pylons import config
+from compression import GzipStream
+import filecmp
+import hashlib
+import os
+import shutil
+import uuid
+import logging
+log = logging.getLogger(__name__)
+
+
+def get_storage():
+    '''
+    Return the storage configured with ckanext.snl.storage (s3 or local)
+    '''
+    backend = config.get('ckanext.snl.storage', 's3')
+    if backend == 'local':
+        return LocalStorage()
+    if backend == 's3':
+        # boto is only needed for S3
+        import s3
+        return s3.S3()
+    raise UnknownStorageError("Unknown storage '%s'" % backend)
+
+
+class Storage(object):
+    '''
+    Interface of the storage the exports are written to.
+
+    Files are addressed by a bucket name (the prefix of a set, e.g.
+    ch.nb.sb) and a filename. Upload streams write a file in parts and
+    can be continued by another process from their upload_id and the
+    ETags of the uploaded parts.
+    '''
+
+    def list_names(self, prefix=None):
+        raise NotImplementedError
+
+    def download_bucket_to_dir(self, prefix, dir_name, ignore=None):
+        raise NotImplementedError
+
+    def get_key_metadata(self, bucket_name, filename):
+        '''
+        Return size, etag and last_modified of a file or None if it does
+        not exist
+        '''
+        raise NotImplementedError
+
+    def get_url_of_file(self, bucket_name, filename):
+        raise NotImplementedError
+
+    def get_size_of_file(self, bucket_name, filename):
+        metadata = self.get_key_metadata(bucket_name, filename)
+        if metadata is None:
+            return None
+        return metadata['size']
+
+    def get_contents_of_file(self, bucket_name, filename):
+        raise NotImplementedError
+
+    def download_file(self, bucket_name, filename, path):
+        raise NotImplementedError
+
+    def upload_string_to_bucket(self, bucket_name, filename, content):
+        raise NotImplementedError
+
+    def upload_file_to_bucket(self, bucket_name, dir_name, filename,
+                              compress=False, footer=None):
+        raise NotImplementedError
+
+    def upload_dir_to_bucket(self, bucket_name, dir_name, filenames=None):
+        raise NotImplementedError
+
+    def sync_dir_to_bucket(self, bucket_name, dir_name):
+        '''
+        Upload the new or changed files of a directory and return their
+        names
+        '''
+        raise NotImplementedError
+
+    def open_upload_stream(self, bucket_name, filename, upload_id=None,
+                           etags=None, pending=None):
+        raise NotImplementedError
+
+    def open_append_stream(self, bucket_name, filename, footer):
+        '''
+        Start a new version of a file that begins with the existing file
+        without its footer.
+
+        Returns the stream to write the appended data to, or None if the
+        file cannot be appended to.
+        '''
+        raise NotImplementedError
+
+    def has_multipart_upload(self, bucket_name, filename, upload_id):
+        raise NotImplementedError
+
+    def upload_compressed_file_to_bucket(self, bucket_name, dir_name,
+                                         filename, footer=None):
+        '''
+        Upload a gzip compressed copy of a file as <filename>.gz, the file
+        is compressed while it is uploaded.
+
+        If the file ends with footer, the footer is compressed as a gzip
+        member of its own, so that data can be appended in front of it
+        later (see open_append_stream).
+        '''
+        source_path = os.path.join(dir_name, filename)
+        source_size = os.stat(source_path).st_size
+        body_size = source_size
+        with open(source_path) as source:
+            if footer:
+                source.seek(source_size - len(footer))
+                if source.read() == footer:
+                    body_size = source_size - len(footer)
+                source.seek(0)
+
+            log.debug('Start compressed upload of %s' % source_path)
+            upload = GzipStream(
+                self.open_upload_stream(bucket_name, filename + '.gz')
+            )
+            try:
+                remaining = body_size
+                while remaining:
+                    chunk = source.read(min(1048576, remaining))
+                    remaining -= len(chunk)
+                    upload.write(chunk)
+                upload.end_member()
+                upload.write(source.read())
+                upload.close()
+            except Exception:
+                upload.cancel()
+                raise
+
+
+class LocalMultipartUpload(object):
+    '''
+    Local counterpart of s3.MultipartStreamUpload, the parts are kept as
+    files in the uploads directory of the storage until the upload is
+    completed.
+    '''
+    def __init__(self, storage, key_name, upload_id=None, etags=None,
+                 pending=None, part_size=16777216):
+        self.storage = storage
+        self.key_name = key_name
+        self.part_size = part_size
+        if upload_id is None:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(storage._upload_dir(upload_id))
+            with open(storage._upload_key_file(upload_id), 'w') as outfile:
+                outfile.write(key_name)
+        self.upload_id = upload_id
+        self.etags = list(etags or [])
+        self.part_count = len(self.etags)
+        self._buffer = []
+        self._buffered = 0
+        if pending:
+            self._buffer.append(pending)
+            self._buffered = len(pending)
+
+    def _part_path(self, part_num):
+        return os.path.join(
+            self.storage._upload_dir(self.upload_id),
+            '%d.part' % part_num
+        )
+
+    def add_part(self, data):
+        self.part_count += 1
+        with open(self._part_path(self.part_count), 'wb') as outfile:
+            outfile.write(data)
+        self.etags[self.part_count - 1:] = [
+            '"%s"' % hashlib.md5(data).hexdigest()
+        ]
+
+    def add_part_from_file(self, source_path, size):
+        '''
+        Add the first size bytes of a file as the next part
+        '''
+        self.part_count += 1
+        md5 = hashlib.md5()
+        with open(source_path, 'rb') as infile:
+            with open(self._part_path(self.part_count), 'wb') as outfile:
+                while size:
+                    chunk = infile.read(min(1048576, size))
+                    size -= len(chunk)
+                    md5.update(chunk)
+                    outfile.write(chunk)
+        self.etags[self.part_count - 1:] = ['"%s"' % md5.hexdigest()]
+
+    def write(self, data):
+        '''
+        Buffer data and return True if it completed a part
+        '''
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.part_size:
+            self.add_part(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+            return True
+        return False
+
+    def get_pending(self):
+        return ''.join(self._buffer)
+
+    def is_uploaded(self, part_count):
+        # parts are written synchronously
+        return part_count <= self.part_count
+
+    def get_etags(self, part_count):
+        return self.etags[:part_count]
+
+    def close(self):
+        '''
+        Write the remaining data and put the parts together
+        '''
+        if self._buffered or not self.part_count:
+            self.add_part(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        target = self.storage._path(self.key_name)
+        tmp_path = target + '.' + self.upload_id
+        with open(tmp_path, 'wb') as outfile:
+            for part_num in range(1, self.part_count + 1):
+                with open(self._part_path(part_num), 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, 1048576)
+        os.rename(tmp_path, target)
+        shutil.rmtree(self.storage._upload_dir(self.upload_id))
+        log.info('Upload of %s completed' % self.key_name)
+
+    def cancel(self, abort=True):
+        if abort:
+            log.error('Upload of %s failed, cancel' % self.key_name)
+            shutil.rmtree(
+                self.storage._upload_dir(self.upload_id),
+                ignore_errors=True
+            )
+
+
+class LocalStorage(Storage):
+    '''
+    Storage in a local directory, to run and profile exports without S3.
+
+    The files are stored as <ckanext.snl.local_storage_dir>/<bucket
+    name>/<filename> and published below ckanext.snl.local_storage_url.
+    '''
+
+    UPLOADS_DIR = '.uploads'
+
+    def __init__(self):
+        try:
+            self.root = os.path.abspath(
+                config['ckanext.snl.local_storage_dir']
+            )
+        except KeyError as e:
+            raise ConfigEntryNotFoundError(
+                "'%s' not found in config"
+                % e.message
+            )
+        self.url = config.get(
+            'ckanext.snl.local_storage_url',
+            'file://' + self.root
+        )
+
+    def __repr__(self):
+        return "<LocalStorage root:%s>" % self.root
+
+    def _path(self, key_name):
+        path = os.path.join(self.root, key_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.root, self.UPLOADS_DIR, upload_id)
+
+    def _upload_key_file(self, upload_id):
+        return os.path.join(self._upload_dir(upload_id), 'key')
+
+    def list_names(self, prefix=None):
+        for dir_path, dir_names, filenames in os.walk(self.root):
+            if self.UPLOADS_DIR in dir_names:
+                dir_names.remove(self.UPLOADS_DIR)
+            for filename in sorted(filenames):
+                path = os.path.join(dir_path, filename)
+                name = os.path.relpath(path, self.root)
+                if prefix is None or name.startswith(prefix):
+                    yield name
+
+    def download_bucket_to_dir(self, prefix, dir_name, ignore=None):
+        files = []
+        for name in self.list_names(prefix):
+            filename = name.replace(prefix, '')
+            if (ignore is not None and filename not in ignore):
+                dump_file = os.path.join(dir_name, filename)
+                log.debug('Dump file %s to %s' % (name, dump_file))
+                shutil.copyfile(os.path.join(self.root, name), dump_file)
+                files.append(dump_file)
+        return files
+
+    def get_key_metadata(self, bucket_name, filename):
+        path = os.path.join(self.root, bucket_name, filename)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return {
+            'size': stat.st_size,
+            # cheap stand-in for the MD5 of S3
+            'etag': '"%x-%x"' % (int(stat.st_mtime), stat.st_size),
+            'last_modified': stat.st_mtime,
+        }
+
+    def get_url_of_file(self, bucket_name, filename):
+        if self.get_key_metadata(bucket_name, filename) is None:
+            return None
+        return '%s/%s/%s' % (self.url, bucket_name, filename)
+
+    def get_contents_of_file(self, bucket_name, filename):
+        path = os.path.join(self.root, bucket_name, filename)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as infile:
+            return infile.read()
+
+    def download_file(self, bucket_name, filename, path):
+        shutil.copyfile(os.path.join(self.root, bucket_name, filename), path)
+
+    def upload_string_to_bucket(self, bucket_name, filename, content):
+        path = self._path(bucket_name + '/' + filename)
+        with open(path + '.tmp', 'w') as outfile:
+            outfile.write(content)
+        os.rename(path + '.tmp', path)
+
+    def upload_file_to_bucket(self, bucket_name, dir_name, filename,
+                              compress=False, footer=None):
+        source_path = os.path.join(dir_name, filename)
+        path = self._path(bucket_name + '/' + filename)
+        shutil.copyfile(source_path, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        log.info('Upload of %s completed' % source_path)
+
+        if compress:
+            self.upload_compressed_file_to_bucket(
+                bucket_name,
+                dir_name,
+                filename,
+                footer
+            )
+
+    def upload_dir_to_bucket(self, bucket_name, dir_name, filenames=None):
+        if filenames is None:
+            filenames = sorted(os.listdir(dir_name))
+        for filename in filenames:
+            self.upload_file_to_bucket(bucket_name, dir_name, filename)
+
+    def sync_dir_to_bucket(self, bucket_name, dir_name):
+        changed = []
+        for filename in sorted(os.listdir(dir_name)):
+            path = os.path.join(self.root, bucket_name, filename)
+            source_path = os.path.join(dir_name, filename)
+            if (not os.path.isfile(path) or
+                    not filecmp.cmp(source_path, path, shallow=False)):
+                changed.append(filename)
+        log.info(
+            'Sync of %s: %d files unchanged'
+            % (dir_name, len(os.listdir(dir_name)) - len(changed))
+        )
+        self.upload_dir_to_bucket(bucket_name, dir_name, changed)
+        return changed
+
+    def open_upload_stream(self, bucket_name, filename, upload_id=None,
+                           etags=None, pending=None):
+        return LocalMultipartUpload(
+            self,
+            bucket_name + '/' + filename,
+            upload_id,
+            etags,
+            pending
+        )
+
+    def open_append_stream(self, bucket_name, filename, footer):
+        path = os.path.join(self.root, bucket_name, filename)
+        if not os.path.isfile(path):
+            return None
+        copy_size = os.stat(path).st_size - len(footer)
+        if copy_size <= 0:
+            return None
+        with open(path, 'rb') as infile:
+            infile.seek(copy_size)
+            if infile.read() != footer:
+                log.debug('%s does not end with the expected footer' % path)
+                return None
+
+        upload = self.open_upload_stream(bucket_name, filename)
+        upload.add_part_from_file(path, copy_size)
+        return upload
+
+    def has_multipart_upload(self, bucket_name, filename, upload_id):
+        key_file = self._upload_key_file(upload_id)
+        if not os.path.isfile(key_file):
+            return False
+        with open(key_file) as infile:
+            return infile.read() == bucket_name + '/' + filename
+
+
+class ConfigEntryNotFoundError(Exception):
+    pass
+
+
+class UnknownStorageError(Exception):
+    pass
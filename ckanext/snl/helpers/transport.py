@@ -0,0 +1,86 @@
+import random
+import time
+import urllib3
+from urllib3.exceptions import HTTPError
+import logging
+log = logging.getLogger(__name__)
+
+
+class HTTPTransport(object):
+    '''
+    HTTP transport for the OAI-PMH clients.
+
+    Connections are kept alive in a pool, responses are requested gzip
+    compressed and transient errors are retried with jittered
+    exponential backoff.
+    '''
+
+    # Status codes worth another try
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(
+            self,
+            num_pools=4,
+            maxsize=4,
+            timeout=300,
+            retries=5,
+            backoff=2,
+            max_backoff=120):
+        self.http = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=maxsize,
+            timeout=timeout
+        )
+        self.headers = urllib3.make_headers(
+            keep_alive=True,
+            accept_encoding='gzip',
+            user_agent='ckanext-snl'
+        )
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _wait_time(self, attempt, response=None):
+        if response is not None:
+            try:
+                return int(response.headers['retry-after'])
+            except (KeyError, ValueError):
+                pass
+        backoff = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+    def request(self, method, url, fields=None, headers=None,
+                preload_content=True):
+        request_headers = dict(self.headers)
+        if headers is not None:
+            request_headers.update(headers)
+
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.http.request(
+                    method,
+                    url,
+                    fields=fields,
+                    headers=request_headers,
+                    preload_content=preload_content
+                )
+                if (response.status not in self.RETRY_STATUS or
+                        attempt >= self.retries):
+                    return response
+                reason = 'HTTP status %s' % response.status
+            except HTTPError, e:
+                if attempt >= self.retries:
+                    raise
+                reason = e
+
+            wait = self._wait_time(attempt, response)
+            if response is not None:
+                response.release_conn()
+            attempt += 1
+            log.warning(
+                'Request to %s failed (%s), retry #%d in %.1fs'
+                % (url, reason, attempt, wait)
+            )
+            time.sleep(wait)
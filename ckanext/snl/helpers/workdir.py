@@ -0,0 +1,18 @@
+from pylons import config
+import os
+import tempfile
+
+
+def get_work_dir(*parts):
+    '''
+    Return the directory for state that has to survive the current
+    process, creating it if necessary
+    '''
+    base_dir = config.get(
+        'ckanext.snl.work_dir',
+        os.path.join(tempfile.gettempdir(), 'ckanext-snl')
+    )
+    path = os.path.join(base_dir, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
@@ -35,48 +35,79 @@ class MetaDataParser(object):
         'export_filename'
     )
 
+    # Languages the terms are translated to
+    TRANSLATION_LANGS = ('fr', 'it', 'en')
+
     def __init__(self, file_name):
         self.file_name = file_name
-        self.meta_xml = open(file_name)
 
     def list_datasets(self):
-        datasets_list = []
-        meta_xml = self.meta_xml
-        parser = etree.XMLParser(encoding='utf-8')
-
-        datasets = etree.fromstring(
-            meta_xml.read(),
-            parser=parser
-        ).findall('dataset')
-
-        for dataset in datasets:
-            datasets_list.append(dataset)
-
-        return datasets_list
+        '''
+        Yield the datasets of the metadata file one by one, each dataset
+        is freed once the next one is read
+        '''
+        with open(self.file_name) as meta_xml:
+            for event, dataset in etree.iterparse(meta_xml, tag='dataset'):
+                parent = dataset.getparent()
+                # only the datasets directly below the root element
+                if parent is None or parent.getparent() is not None:
+                    continue
+                yield dataset
+                dataset.clear()
+                while dataset.getprevious() is not None:
+                    del parent[0]
+
+    def _read_values(self, attributes):
+        '''
+        Read the texts of all languages of all attributes in one pass,
+        returns {attribute: {language: text}}
+        '''
+        values = {}
+        for attribute in attributes:
+            texts = values.setdefault(attribute.tag, {})
+            for text in attribute:
+                texts.setdefault(text.tag, text.text)
+        return values
 
     def parse_set(self, dataset):
         '''
-        Parse one dataset and its resources and return them as dict
+        Parse one dataset and its resources and return them as dict,
+        the translations are collected in the same pass
         '''
 
         log.debug('parsing dataset')
 
-        dataset_attrs = dataset.find('dataset_attributes')
         metadata = {
             'id': dataset.get('id')
         }
+        dataset_values = None
+        resources_values = []
+        for child in dataset:
+            if child.tag == 'dataset_attributes' and dataset_values is None:
+                dataset_values = self._read_values(child)
+            elif child.tag == 'resource':
+                resource_attrs = child.find('resource_attributes')
+                resources_values.append(self._read_values(resource_attrs))
 
         for attr in self.DATASET_ATTRIBUTES:
-            metadata[attr] = dataset_attrs.find(attr).find('de').text
+            metadata[attr] = dataset_values[attr]['de']
 
-        log.debug(metadata)
+        # optional filter for the records of the OAI set, e.g. 993$a=sb
+        if 'record_filter' in dataset_values:
+            metadata['record_filter'] = dataset_values['record_filter']['de']
 
-        if 'name' in metadata:
-            metadata['name'] = munge_tag(metadata['name'])
-            metadata['resources'] = self._build_resources_list(dataset)
-            metadata['translations'] = self._build_term_translations(
-                dataset
+        metadata['name'] = munge_tag(metadata['name'])
+        metadata['resources'] = [
+            dict(
+                (attr, values[attr]['de'])
+                for attr in self.RESOURCE_ATTRIBUTES
             )
+            for values in resources_values
+        ]
+        metadata['translations'] = self._build_term_translations(
+            dataset_values,
+            resources_values
+        )
 
         log.debug(metadata)
 
@@ -94,79 +125,42 @@ class MetaDataParser(object):
 
         return cleaned
 
-    def _build_resources_list(self, dataset):
-        '''
-        Create a list of all resources in the dataset
-        '''
-        resources_list = []
-        resources = dataset.findall('resource')
-        for resource in resources:
-            current = {}
-            for attribute in self.RESOURCE_ATTRIBUTES:
-                current[attribute] = resource.find('resource_attributes')\
-                    .find(attribute).find('de').text
-            resources_list.append(current)
-
-        return resources_list
-
-    def _build_term_translations(self, dataset):
+    def _build_term_translations(self, dataset_values, resources_values):
         """
         Generate meaningful term translations for all translated values
         """
         translations = []
-        langs = ['fr', 'it', 'en']
 
-        dataset_attrs = dataset.find('dataset_attributes')
         for attr in self.DATASET_ATTRIBUTES:
-            term = dataset_attrs.find(attr).find('de').text
-            log.debug('Create translation for %s' % term)
+            texts = dataset_values[attr]
+            term = texts['de']
             if attr == 'tags':
-                for lang in langs:
-                    trans = dataset_attrs.find(attr).find(lang).text
-                    # Tags are split and translated individually
-                    split_term = self._clean_values(term.split(','))
-                    split_trans = self._clean_values(trans.split(','))
-
+                # Tags are split and translated individually
+                split_term = self._clean_values(term.split(','))
+                for lang in self.TRANSLATION_LANGS:
+                    split_trans = self._clean_values(texts[lang].split(','))
                     if len(split_term) == len(split_trans):
-                        for term, trans in zip(split_term, split_trans):
-                            log.debug(
-                                'Term (tag): %s, Translation (%s): %s'
-                                % (term, lang, trans)
-                            )
+                        for tag, trans in zip(split_term, split_trans):
                             translations.append({
                                 u'lang_code': lang,
-                                u'term': munge_tag(term),
+                                u'term': munge_tag(tag),
                                 u'term_translation': munge_tag(trans)
                             })
             else:
-                for lang in langs:
-                    trans = dataset_attrs.find(attr).find(lang).text
-                    if term != trans:
-                        log.debug(
-                            'Term: %s, Translation (%s): %s'
-                            % (term, lang, trans)
-                        )
-                        translations.append({
-                            u'lang_code': lang,
-                            u'term': term,
-                            u'term_translation': trans
-                        })
-        resources = dataset.findall('resource')
-        for resource in resources:
+                self._add_translations(translations, texts)
+
+        for values in resources_values:
             for attr in self.RESOURCE_ATTRIBUTES:
-                res_attr = resource.find('resource_attributes')
-                term = res_attr.find(attr).find('de').text
-                log.debug('Create translation for %s' % term)
-                for lang in langs:
-                    trans = res_attr.find(attr).find(lang).text
-                    if term != trans:
-                        log.debug(
-                            'Term: %s, Translation (%s): %s'
-                            % (term, lang, trans)
-                        )
-                        translations.append({
-                            u'lang_code': lang,
-                            u'term': term,
-                            u'term_translation': trans
-                        })
+                self._add_translations(translations, values[attr])
         return translations
+
+    def _add_translations(self, translations, texts):
+        term = texts['de']
+        for lang in self.TRANSLATION_LANGS:
+            trans = texts[lang]
+            if term != trans:
+                translations.append({
+                    u'lang_code': lang,
+                    u'term': term,
+                    u'term_translation': trans
+                })
@@ -0,0 +1,145 @@
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from xml.sax.saxutils import escape
+
+OAI_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+    '<responseDate>2020-01-20T00:00:00Z</responseDate>'
+    '<request>%s</request>'
+)
+OAI_FOOTER = '</OAI-PMH>'
+
+MARC_RECORD = (
+    '<record><header>'
+    '<identifier>%(identifier)s</identifier>'
+    '<datestamp>%(datestamp)s</datestamp>'
+    '</header><metadata>'
+    '<record xmlns="http://www.loc.gov/MARC21/slim">'
+    '<controlfield tag="001">%(identifier)s</controlfield>'
+    '<datafield tag="993" ind1=" " ind2=" ">'
+    '<subfield code="a">%(value)s</subfield>'
+    '</datafield>'
+    '</record>'
+    '</metadata></record>'
+)
+
+
+class OAIServer(object):
+    '''
+    OAI-PMH repository on a local port for the tests. It serves Identify
+    and ListRecords of the records list, which can be changed between
+    requests. A record is a (identifier, datestamp, value) tuple, value
+    is written to the field 993$a.
+
+    The resumption tokens contain the offset of the next page, so that
+    they keep working across server restarts. All pages from fail_page
+    (counted from 0) on answer with HTTP 400.
+    '''
+    def __init__(self, records=None, page_size=100,
+                 granularity='YYYY-MM-DDThh:mm:ssZ'):
+        self.records = list(records or [])
+        self.page_size = page_size
+        self.granularity = granularity
+        self.fail_page = None
+        self.requests = []
+        self.httpd = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/oai' % self.httpd.server_port
+
+    def start(self):
+        server = self
+
+        class Handler(OAIRequestHandler):
+            oai_server = server
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def list_records(self, args):
+        if 'resumptionToken' in args:
+            offset, from_ = args['resumptionToken'].split(':', 1)
+            offset = int(offset)
+        else:
+            offset, from_ = 0, args.get('from', '')
+
+        if (self.fail_page is not None and
+                offset >= self.fail_page * self.page_size):
+            return None
+
+        records = [
+            x for x in self.records if x[1][:len(from_)] >= from_
+        ]
+        if not records:
+            return '<error code="noRecordsMatch"/>'
+
+        page = records[offset:offset + self.page_size]
+        token = ''
+        if offset + self.page_size < len(records):
+            token = '%d:%s' % (offset + self.page_size, from_)
+        return '<ListRecords>%s<resumptionToken>%s</resumptionToken>' \
+            '</ListRecords>' % (
+                ''.join(
+                    MARC_RECORD % {
+                        'identifier': escape(identifier),
+                        'datestamp': datestamp,
+                        'value': escape(value),
+                    }
+                    for identifier, datestamp, value in page
+                ),
+                token
+            )
+
+    def identify(self, args):
+        return (
+            '<Identify>'
+            '<repositoryName>Test</repositoryName>'
+            '<baseURL>%s</baseURL>'
+            '<protocolVersion>2.0</protocolVersion>'
+            '<adminEmail>test@example.com</adminEmail>'
+            '<earliestDatestamp>2000-01-01T00:00:00Z</earliestDatestamp>'
+            '<deletedRecord>no</deletedRecord>'
+            '<granularity>%s</granularity>'
+            '</Identify>' % (self.url, self.granularity)
+        )
+
+
+class OAIRequestHandler(BaseHTTPRequestHandler):
+    oai_server = None
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        args = dict(urlparse.parse_qsl(query))
+        self.oai_server.requests.append(args)
+
+        verb = args.get('verb')
+        if verb == 'ListRecords':
+            body = self.oai_server.list_records(args)
+        elif verb == 'Identify':
+            body = self.oai_server.identify(args)
+        else:
+            body = '<error code="badVerb"/>'
+
+        if body is None:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        data = OAI_HEADER % escape(self.oai_server.url) + body + OAI_FOOTER
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
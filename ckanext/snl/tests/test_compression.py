@@ -0,0 +1,72 @@
+import gzip
+import unittest
+from StringIO import StringIO
+
+from ckanext.snl.helpers.compression import GzipStream, gzip_member
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.data = StringIO()
+        self.closed = False
+        self.cancelled = None
+
+    def write(self, data):
+        self.data.write(data)
+
+    def close(self):
+        self.closed = True
+
+    def cancel(self, abort=True):
+        self.cancelled = abort
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TestGzipStream(unittest.TestCase):
+
+    def test_members_decompress_as_one_file(self):
+        stream = FakeStream()
+        compressed = GzipStream(stream)
+        compressed.write('<records>\n')
+        compressed.write('<record/>\n')
+        compressed.end_member()
+        compressed.write('</records>')
+        compressed.close()
+
+        self.assertTrue(stream.closed)
+        self.assertEqual(
+            gunzip(stream.data.getvalue()),
+            '<records>\n<record/>\n</records>'
+        )
+
+    def test_trailing_member_can_be_replaced(self):
+        footer = gzip_member('</records>')
+        stream = FakeStream()
+        compressed = GzipStream(stream)
+        compressed.write('<records>\n<record>1</record>\n')
+        compressed.end_member()
+        stream.write(footer)
+        data = stream.data.getvalue()
+        self.assertTrue(data.endswith(footer))
+
+        # append a record in front of the footer
+        appended = data[:-len(footer)] + gzip_member('<record>2</record>\n')
+        self.assertEqual(
+            gunzip(appended + footer),
+            '<records>\n<record>1</record>\n<record>2</record>\n</records>'
+        )
+
+    def test_end_member_without_data_writes_nothing(self):
+        stream = FakeStream()
+        compressed = GzipStream(stream)
+        compressed.end_member()
+        compressed.end_member()
+        self.assertEqual(stream.data.getvalue(), '')
+
+    def test_cancel_is_passed_on(self):
+        stream = FakeStream()
+        GzipStream(stream).cancel(abort=False)
+        self.assertEqual(stream.cancelled, False)
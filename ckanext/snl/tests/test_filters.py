@@ -0,0 +1,53 @@
+import unittest
+
+from lxml import etree
+
+from ckanext.snl.helpers.filters import RecordFilter, InvalidFilterError
+
+
+def marc_record(value, control_number='abc'):
+    return etree.XML(
+        '<record xmlns="http://www.loc.gov/MARC21/slim">'
+        '<controlfield tag="001">%s</controlfield>'
+        '<datafield tag="993"><subfield code="a">%s</subfield></datafield>'
+        '</record>' % (control_number, value)
+    )
+
+
+class TestRecordFilter(unittest.TestCase):
+
+    def test_from_spec_with_subfield_and_values(self):
+        record_filter = RecordFilter.from_spec('993$a=sb, sbx')
+        self.assertEqual(record_filter.tag, '993')
+        self.assertEqual(record_filter.code, 'a')
+        self.assertEqual(record_filter.values, frozenset(['sb', 'sbx']))
+        self.assertEqual(str(record_filter), '993$a=sb,sbx')
+
+    def test_from_spec_without_values(self):
+        record_filter = RecordFilter.from_spec(' 993 ')
+        self.assertEqual(record_filter.code, None)
+        self.assertEqual(record_filter.values, frozenset())
+        self.assertTrue(record_filter(marc_record('anything')))
+
+    def test_from_spec_rejects_invalid_specs(self):
+        for spec in ('99$a', '993$ab', '993a=sb', '', '993=sb', '001$a=abc'):
+            self.assertRaises(InvalidFilterError, RecordFilter.from_spec, spec)
+
+    def test_filter_keeps_matching_records(self):
+        record_filter = RecordFilter.from_spec('993$a=sb')
+        self.assertTrue(record_filter(marc_record('sb')))
+        self.assertFalse(record_filter(marc_record('sbx')))
+        self.assertFalse(record_filter(None))
+        self.assertFalse(record_filter(etree.XML('<record/>')))
+        self.assertEqual(record_filter.kept, 1)
+        self.assertEqual(record_filter.rejected, 3)
+
+    def test_filter_on_missing_field(self):
+        record_filter = RecordFilter.from_spec('994')
+        self.assertFalse(record_filter(marc_record('sb')))
+
+    def test_filter_on_control_field(self):
+        record_filter = RecordFilter.from_spec('001=abc')
+        self.assertTrue(record_filter(marc_record('sb')))
+        self.assertFalse(record_filter(marc_record('sb', 'abd')))
+        self.assertTrue(RecordFilter.from_spec('001')(marc_record('sb')))
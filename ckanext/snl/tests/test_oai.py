@@ -0,0 +1,340 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from lxml import etree
+from pylons import config
+
+from ckanext.snl.helpers.oai import OAI
+from ckanext.snl.helpers.storage import LocalStorage, LocalMultipartUpload
+from ckanext.snl.tests.oai_server import OAIServer
+
+MARC_NS = 'http://www.loc.gov/MARC21/slim'
+
+
+class SmallPartStorage(LocalStorage):
+    '''
+    LocalStorage with small parts, so that an export of a few hundred
+    records completes parts and takes checkpoints
+    '''
+    upload_class = LocalMultipartUpload
+
+    def open_upload_stream(self, bucket_name, filename, upload_id=None,
+                           etags=None, pending=None):
+        return self.upload_class(
+            self,
+            bucket_name + '/' + filename,
+            upload_id,
+            etags,
+            pending,
+            part_size=4096
+        )
+
+
+class SlowUpload(LocalMultipartUpload):
+    '''
+    Upload that is slower than the harvest, its newest part is always
+    still being sent
+    '''
+    def is_uploaded(self, part_count):
+        return part_count == 0 or part_count < self.part_count
+
+
+class SlowStorage(SmallPartStorage):
+    upload_class = SlowUpload
+
+
+def make_records(start, stop, datestamp=None, value='sb'):
+    '''
+    Records start to stop-1 with value in 993$a, ten records share a
+    datestamp unless one is given
+    '''
+    base = datetime.datetime(2020, 1, 20, 10)
+    records = []
+    for i in range(start, stop):
+        if datestamp is None:
+            stamp = (base + datetime.timedelta(seconds=i // 10)).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'
+            )
+        else:
+            stamp = datestamp
+        records.append(('oai:test:%05d' % i, stamp, value))
+    return records
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.storage_dir = os.path.join(self.temp_dir, 'storage')
+        self.work_dir = os.path.join(self.temp_dir, 'work')
+        os.mkdir(self.storage_dir)
+        self.config = {}
+        self.set_config('ckanext.snl.storage', 'local')
+        self.set_config('ckanext.snl.local_storage_dir', self.storage_dir)
+        self.set_config('ckanext.snl.work_dir', self.work_dir)
+        self.set_config('ckanext.snl.export_compression', 'gzip')
+
+        self.server = OAIServer(make_records(0, 2000))
+        self.server.start()
+        self.oai = OAI(
+            'ch.nb',
+            self.server.url,
+            'marcxml',
+            export_storage=SmallPartStorage()
+        )
+
+    def tearDown(self):
+        self.server.stop()
+        for key, value in self.config.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        shutil.rmtree(self.temp_dir)
+
+    def set_config(self, key, value):
+        if key not in self.config:
+            self.config[key] = config.get(key)
+        config[key] = value
+
+    def exported_ids(self, set_name, filename='records.xml'):
+        path = os.path.join(self.storage_dir, 'ch.nb.' + set_name, filename)
+        if filename.endswith('.gz'):
+            data = gzip.open(path).read()
+        else:
+            data = open(path).read()
+        tree = etree.fromstring(data)
+        return tree.xpath(
+            '//marc:controlfield[@tag="001"]/text()',
+            namespaces={'marc': MARC_NS}
+        )
+
+    def manifest(self, set_name):
+        path = os.path.join(
+            self.work_dir,
+            'export',
+            'ch.nb.' + set_name,
+            'records.xml',
+            OAI.MANIFEST_FILE
+        )
+        if not os.path.exists(path):
+            return None
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+
+    def harvest_state(self, set_name):
+        path = os.path.join(
+            self.storage_dir,
+            'ch.nb.' + set_name,
+            OAI.HARVEST_STATE_FILE
+        )
+        with open(path) as state_file:
+            return json.load(state_file)['marcxml']
+
+    def list_requests(self):
+        return [
+            x for x in self.server.requests if x['verb'] == 'ListRecords'
+        ]
+
+    def all_ids(self):
+        return [x[0] for x in self.server.records]
+
+    def test_streamed_export(self):
+        self.oai.export('e-diss')
+        self.assertEqual(self.exported_ids('e-diss'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('e-diss', 'records.xml.gz'),
+            self.all_ids()
+        )
+        self.assertEqual(self.manifest('e-diss'), None)
+
+    def test_streamed_export_resumes_from_checkpoint(self):
+        self.server.fail_page = 13
+        self.assertRaises(Exception, self.oai.export, 'e-diss')
+        checkpoint = self.manifest('e-diss')
+        self.assertEqual(checkpoint['count'], 1000)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.storage_dir, 'ch.nb.e-diss', 'records.xml')
+        ))
+
+        self.server.fail_page = None
+        self.server.requests = []
+        self.oai.export('e-diss')
+        self.assertEqual(
+            self.list_requests()[0].get('resumptionToken'),
+            checkpoint['token']
+        )
+        self.assertEqual(self.exported_ids('e-diss'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('e-diss', 'records.xml.gz'),
+            self.all_ids()
+        )
+        self.assertEqual(self.manifest('e-diss'), None)
+
+    def test_streamed_export_with_slow_uploads(self):
+        self.oai.storage = SlowStorage()
+        self.server.fail_page = 13
+        self.assertRaises(Exception, self.oai.export, 'e-diss')
+        checkpoint = self.manifest('e-diss')
+        self.assertEqual(checkpoint['count'], 500)
+
+        self.server.fail_page = None
+        self.oai.export('e-diss')
+        self.assertEqual(self.exported_ids('e-diss'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('e-diss', 'records.xml.gz'),
+            self.all_ids()
+        )
+
+    def test_append_export_resumes_from_checkpoint(self):
+        self.server.fail_page = 13
+        self.assertRaises(
+            Exception,
+            self.oai.export,
+            'NewBib',
+            append=True
+        )
+        checkpoint = self.manifest('NewBib')
+        self.assertEqual(checkpoint['count'], 1000)
+        self.assertEqual(len(checkpoint['step_files']), 2)
+
+        self.server.fail_page = None
+        self.server.requests = []
+        self.oai.export('NewBib', append=True)
+        self.assertEqual(
+            self.list_requests()[0].get('resumptionToken'),
+            checkpoint['token']
+        )
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('NewBib', 'records.xml.gz'),
+            self.all_ids()
+        )
+        self.assertEqual(self.manifest('NewBib'), None)
+
+    def fail_after_compose(self, patcher):
+        '''
+        Append 600 records to an export of 1200 records, fail with patcher
+        after records.xml was composed, and run the export again
+        '''
+        self.server.records = make_records(0, 1200)
+        self.oai.export('NewBib', append=True)
+
+        self.server.records += make_records(1200, 1800)
+        with patcher:
+            self.assertRaises(
+                IOError,
+                self.oai.export,
+                'NewBib',
+                append=True
+            )
+        self.assertTrue(self.manifest('NewBib')['composed'])
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+
+        self.server.requests = []
+        self.oai.export('NewBib', append=True)
+        self.assertEqual(self.list_requests(), [])
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('NewBib', 'records.xml.gz'),
+            self.all_ids()
+        )
+        self.assertEqual(
+            self.harvest_state('NewBib')['last_datestamp'],
+            '2020-01-20T10:02:59Z'
+        )
+        self.assertEqual(self.manifest('NewBib'), None)
+
+    def test_composed_export_is_not_appended_again(self):
+        self.fail_after_compose(mock.patch.object(
+            OAI,
+            '_save_harvest_mark',
+            side_effect=IOError('disk full')
+        ))
+
+    def test_composed_export_completes_the_compressed_copy(self):
+        close = LocalMultipartUpload.close
+
+        def close_upload(upload):
+            if upload.key_name.endswith('.gz'):
+                raise IOError('disk full')
+            close(upload)
+
+        self.fail_after_compose(mock.patch.object(
+            LocalMultipartUpload,
+            'close',
+            close_upload
+        ))
+
+    def test_incremental_export_keeps_records_of_the_same_datestamp(self):
+        self.server.records = make_records(0, 1200)
+        self.oai.export('NewBib', append=True)
+        state = self.harvest_state('NewBib')
+        self.assertEqual(state['last_datestamp'], '2020-01-20T10:01:59Z')
+        self.assertEqual(
+            state['identifiers'],
+            ['oai:test:%05d' % i for i in range(1190, 1200)]
+        )
+
+        # new records with the datestamp of the last harvest and later
+        self.server.records += make_records(
+            1200, 1203, '2020-01-20T10:01:59Z'
+        )
+        self.server.records += make_records(1203, 1205)
+        self.server.requests = []
+        self.oai.export('NewBib', append=True)
+        self.assertEqual(
+            self.list_requests()[0].get('from'),
+            '2020-01-20T10:01:59Z'
+        )
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+        self.assertEqual(
+            self.exported_ids('NewBib', 'records.xml.gz'),
+            self.all_ids()
+        )
+        state = self.harvest_state('NewBib')
+        self.assertEqual(state['last_datestamp'], '2020-01-20T10:02:00Z')
+
+        # nothing new, the export stays as it is
+        self.oai.export('NewBib', append=True)
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+
+    def test_incremental_export_with_day_granularity(self):
+        self.server.granularity = 'YYYY-MM-DD'
+        self.server.records = make_records(0, 3, '2020-01-20T00:00:00Z')
+        self.oai.export('NewBib', append=True)
+
+        self.server.records += make_records(3, 5, '2020-01-20T00:00:00Z')
+        self.server.requests = []
+        self.oai.export('NewBib', append=True)
+        self.assertEqual(self.list_requests()[0].get('from'), '2020-01-20')
+        self.assertEqual(self.exported_ids('NewBib'), self.all_ids())
+        self.assertEqual(
+            sorted(self.harvest_state('NewBib')['identifiers']),
+            self.all_ids()
+        )
+
+    def test_incremental_export_moves_past_rejected_records(self):
+        self.server.records = make_records(0, 50)
+        self.oai.export('sb', append=True, record_filter='993$a=sb')
+        self.assertEqual(
+            self.harvest_state('sb')['last_datestamp'],
+            '2020-01-20T10:00:04Z'
+        )
+
+        self.server.records += make_records(50, 300, value='sbx')
+        self.oai.export('sb', append=True, record_filter='993$a=sb')
+        self.assertEqual(
+            self.exported_ids('sb'),
+            ['oai:test:%05d' % i for i in range(50)]
+        )
+        self.assertEqual(
+            self.harvest_state('sb')['last_datestamp'],
+            '2020-01-20T10:00:29Z'
+        )
@@ -0,0 +1,84 @@
+import unittest
+
+import mock
+
+from ckanext.snl.helpers.s3 import UploadTuner
+
+MB = 1048576
+
+
+class SimulatedLink(object):
+    '''
+    Uplink where one connection gets at most per_connection bytes/s and
+    all connections together share capacity bytes/s. More connections
+    than the link can carry lose throughput to congestion.
+    '''
+    def __init__(self, per_connection, capacity, congestion=0.8):
+        self.per_connection = per_connection
+        self.capacity = capacity
+        self.congestion = congestion
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def upload_window(self, tuner):
+        '''
+        Upload one window of parts with the settings of the tuner
+        '''
+        concurrency = tuner.concurrency
+        part_size = tuner.part_size
+        rate = min(self.per_connection, self.capacity / concurrency)
+        if concurrency * self.per_connection > self.capacity:
+            rate *= self.congestion
+        elapsed = part_size / rate
+        self.now += elapsed
+        for i in range(concurrency):
+            tuner.add_part(part_size, elapsed)
+
+
+class TestUploadTuner(unittest.TestCase):
+
+    def tune(self, link, windows, **kwargs):
+        with mock.patch('ckanext.snl.helpers.s3.time.time', link.time):
+            tuner = UploadTuner(
+                kwargs.get('min_concurrency', 1),
+                kwargs.get('max_concurrency', 16),
+                kwargs.get('min_part_size', 5 * MB),
+                kwargs.get('max_part_size', 256 * MB),
+                kwargs.get('part_size', 8 * MB)
+            )
+            for i in range(windows):
+                link.upload_window(tuner)
+        return tuner
+
+    def test_concurrency_converges_to_the_capacity(self):
+        # the link is saturated by 5 connections
+        link = SimulatedLink(20.0 * MB, 100.0 * MB)
+        tuner = self.tune(link, 40)
+        concurrency = [x[1] for x in tuner.curve[-10:]]
+        self.assertTrue(min(concurrency) >= 4, concurrency)
+        self.assertTrue(max(concurrency) <= 6, concurrency)
+
+    def test_concurrency_stays_within_limits(self):
+        link = SimulatedLink(20.0 * MB, 1000.0 * MB)
+        tuner = self.tune(link, 30, min_concurrency=2, max_concurrency=3)
+        self.assertEqual(
+            set(x[1] for x in tuner.curve),
+            set([2, 3])
+        )
+
+    def test_part_size_follows_the_connection_throughput(self):
+        # a part should take about target_part_time (10s)
+        link = SimulatedLink(2.0 * MB, 2.0 * MB)
+        tuner = self.tune(link, 5, max_concurrency=1)
+        self.assertEqual(tuner.part_size, 20 * MB)
+
+    def test_part_size_is_clamped(self):
+        link = SimulatedLink(100.0 * MB, 100.0 * MB)
+        tuner = self.tune(link, 5, max_concurrency=1, max_part_size=64 * MB)
+        self.assertEqual(tuner.part_size, 64 * MB)
+
+        link = SimulatedLink(0.1 * MB, 0.1 * MB)
+        tuner = self.tune(link, 2, max_concurrency=1)
+        self.assertEqual(tuner.part_size, 5 * MB)